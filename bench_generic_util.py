@@ -0,0 +1,291 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# File: bench_generic_util.py
+#
+#===============================================================================
+# DESCRIPTION:
+#
+# Benchmarks for the large file functions in generic_util (split_file,
+# randomly_sample_file, scramble_file_lines, make_dev_train_sets,
+# file_generator, ...).  Writes deterministic synthetic data, times every
+# function in a fresh process, records its peak memory and the bytes it read
+# and wrote, and saves the results as JSON so that runs from different commits
+# can be compared.
+#
+#===============================================================================
+# USAGE:
+# python bench_generic_util.py --n_lines 1000000 --output before.json
+# ... change generic_util ...
+# python bench_generic_util.py --n_lines 1000000 --output after.json
+# python bench_generic_util.py --compare before.json after.json --threshold .1
+#
+# (the last command exits with status 1 if any benchmark got more than 10% slower)
+#
+#===============================================================================
+
+
+#standard modules
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+#third party modules
+import numpy as np
+import generic_util as gu
+
+
+#===============================================================================
+# SYNTHETIC DATA
+#===============================================================================
+
+def make_synthetic_file(fname, n_lines, line_length = 60, content = 'int', seed = 0, chunk_size = 100000):
+    """writes n_lines lines of about line_length characters to fname, the same ones for
+    the same arguments.  content = 'int' gives whitespace separated integers (what
+    file_generator reads); content = 'text' gives lines of made up words.  The file is
+    written a chunk at a time, so it can be many GB.
+    """
+    rng = np.random.RandomState(seed)
+    letters = np.array(list('abcdefghijklmnopqrstuvwxyz'))
+    vocab = [''.join(rng.choice(letters, rng.randint(2, 10))) for _ in range(5000)]
+    with open(fname, 'w') as f:
+        for start in xrange(0, n_lines, chunk_size):
+            n = min(chunk_size, n_lines - start)
+            if content == 'int':
+                # six digit numbers and a space
+                rows = rng.randint(0, 10**6, size=(n, max(1, line_length//7)))
+                f.write(''.join(' '.join(map(str, row)) + '\n' for row in rows.tolist()))
+            else:
+                # words average about 7 characters with their space
+                rows = rng.randint(0, len(vocab), size=(n, max(1, line_length//7)))
+                f.write(''.join(' '.join(vocab[i] for i in row) + '\n' for row in rows.tolist()))
+
+
+#===============================================================================
+# BENCHMARKS
+#===============================================================================
+# each takes the directory to write to, the text file and the integer file
+
+def bench_split_file_lines(out_dir, text_fname, int_fname):
+    gu.split_file(text_fname, os.path.join(out_dir, 'split'), n_splits = 16)
+
+def bench_split_file_bytes(out_dir, text_fname, int_fname):
+    gu.split_file(text_fname, os.path.join(out_dir, 'split'), n_splits = 16, mode = 'bytes')
+
+def bench_split_file_key(out_dir, text_fname, int_fname):
+    gu.split_file(text_fname, os.path.join(out_dir, 'split'), n_splits = 1000, mode = 'key', key = lambda line: line.split()[0])
+
+def bench_randomly_sample_file_index(out_dir, text_fname, int_fname):
+    gu.randomly_sample_file(text_fname, os.path.join(out_dir, 'sample'), 1000, seed = 0)
+
+def bench_randomly_sample_file_reservoir(out_dir, text_fname, int_fname):
+    gu.randomly_sample_file(text_fname, os.path.join(out_dir, 'sample'), 1000, mode = 'reservoir', seed = 0)
+
+def bench_scramble_file_lines(out_dir, text_fname, int_fname):
+    gu.scramble_file_lines([text_fname, int_fname], [os.path.join(out_dir, 'text'), os.path.join(out_dir, 'int')])
+
+def bench_scramble_file_lines_external(out_dir, text_fname, int_fname):
+    budget = os.path.getsize(text_fname)//8
+    gu.scramble_file_lines(text_fname, os.path.join(out_dir, 'text'), memory_budget = budget)
+
+def bench_make_dev_train_sets(out_dir, text_fname, int_fname):
+    gu.make_dev_train_sets(text_fname, [os.path.join(out_dir, name) for name in ['train', 'dev', 'test']],
+            [.8, .1, .1])
+
+def bench_make_dev_train_sets_hash(out_dir, text_fname, int_fname):
+    gu.make_dev_train_sets(text_fname, [os.path.join(out_dir, name) for name in ['train', 'dev', 'test']],
+            [.8, .1, .1], assign = 'hash')
+
+def bench_sort_file(out_dir, text_fname, int_fname):
+    gu.sort_file(text_fname, os.path.join(out_dir, 'sorted'))
+
+def bench_sort_file_external(out_dir, text_fname, int_fname):
+    budget = os.path.getsize(text_fname)//8
+    gu.sort_file(text_fname, os.path.join(out_dir, 'sorted'), unique = True, memory_budget = budget)
+
+def bench_file_generator(out_dir, text_fname, int_fname):
+    for row in gu.file_generator(int_fname):
+        pass
+
+def bench_file_batch_generator(out_dir, text_fname, int_fname):
+    for values, offsets in gu.file_batch_generator(int_fname):
+        pass
+
+def bench_minibatch_loader(out_dir, text_fname, int_fname):
+    for batch in gu.MinibatchLoader(int_fname, 256, ragged = True, n_shards = 64, seed = 0):
+        pass
+
+def bench_str_parse_file(out_dir, text_fname, int_fname):
+    for tokens in gu.str_parse_file(text_fname):
+        pass
+
+BENCHMARKS = [
+    bench_split_file_lines,
+    bench_split_file_bytes,
+    bench_split_file_key,
+    bench_randomly_sample_file_index,
+    bench_randomly_sample_file_reservoir,
+    bench_scramble_file_lines,
+    bench_scramble_file_lines_external,
+    bench_make_dev_train_sets,
+    bench_make_dev_train_sets_hash,
+    bench_sort_file,
+    bench_sort_file_external,
+    bench_file_generator,
+    bench_file_batch_generator,
+    bench_minibatch_loader,
+    bench_str_parse_file,
+]
+
+
+#===============================================================================
+# RUNNING AND COMPARING
+#===============================================================================
+
+def io_counters():
+    """returns (bytes read, bytes written) by this process so far, or (None, None) if
+    the os doesn't say (only linux does, in /proc/self/io).
+    """
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+    except IOError:
+        return None, None
+    return int(counters['rchar']), int(counters['wchar'])
+
+
+def run_one(name, text_fname, int_fname, warm = False):
+    """runs the benchmark name once, in this process, and returns its measurements.  This
+    is run in a fresh process for every benchmark, so that peak memory is its own.  Unless
+    warm, the line indexes and binary caches of the data are deleted first.
+    """
+    fn = dict((bench.__name__, bench) for bench in BENCHMARKS)[name]
+    if not warm:
+        for fname in [text_fname, int_fname]:
+            for suffix in [gu.LineIndex.SUFFIX, gu.CACHE_VALUES_SUFFIX, gu.CACHE_OFFSETS_SUFFIX]:
+                if os.path.exists(fname + suffix):
+                    os.remove(fname + suffix)
+    out_dir = tempfile.mkdtemp(prefix='bench_', dir=os.path.dirname(os.path.abspath(text_fname)))
+    try:
+        read_before, written_before = io_counters()
+        start = time.time()
+        fn(out_dir, text_fname, int_fname)
+        seconds = time.time() - start
+        read_after, written_after = io_counters()
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+    return {'seconds': seconds,
+            # pool workers are counted by their peak, but their i/o isn't counted
+            'peak_rss_kb': max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, 
+                    resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss),
+            'bytes_read': read_after - read_before if read_before is not None else None,
+            'bytes_written': written_after - written_before if written_before is not None else None}
+
+
+def run_all(text_fname, int_fname, names, repeat, warm = False):
+    """runs every benchmark in names repeat times, each in a fresh process, and keeps the
+    fastest run.
+    """
+    results = {}
+    for name in names:
+        runs = []
+        for _ in range(repeat):
+            output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--run_one', name,
+                    '--text', text_fname, '--int', int_fname] + (['--warm'] if warm else []))
+            runs.append(json.loads(output.splitlines()[-1]))
+        results[name] = min(runs, key=lambda run: run['seconds'])
+        gu.colorprint('%-40s %8.3fs %10d KB'%(name, results[name]['seconds'], results[name]['peak_rss_kb']), 'teal')
+    try:
+        results['import_generic_util'] = {'seconds': gu.check_import_time(max_seconds = float('inf'))}
+    except AssertionError as e:
+        gu.colorprint(str(e), 'red')
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old_fname, new_fname, threshold):
+    """prints how much every benchmark sped up or slowed down from the results in
+    old_fname to those in new_fname, and returns the names of those that got more than
+    threshold (a fraction) slower.
+    """
+    with open(old_fname) as f:
+        old = json.load(f)['results']
+    with open(new_fname) as f:
+        new = json.load(f)['results']
+    regressions = []
+    for name in sorted(set(old) & set(new)):
+        change = new[name]['seconds']/old[name]['seconds'] - 1 if old[name]['seconds'] else 0.
+        regressed = change > threshold
+        if regressed:
+            regressions.append(name)
+        gu.colorprint('%-40s %8.3fs -> %8.3fs (%+.1f%%)'%(name, old[name]['seconds'], new[name]['seconds'], 100*change),
+                'red' if regressed else 'green?')
+    return regressions
+
+
+def get_args():
+    """
+    parses command line args"""
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_lines', type = int, default = 200000)
+    parser.add_argument('--line_length', type = int, default = 60)
+    parser.add_argument('--data_dir', default = None, help = 'where to write the synthetic data (default: a temporary directory)')
+    parser.add_argument('--output', default = 'bench_output.txt', help = 'where to write the JSON results')
+    parser.add_argument('--repeat', type = int, default = 3)
+    parser.add_argument('--only', nargs = '*', default = None, help = 'names of the benchmarks to run')
+    parser.add_argument('--compare', nargs = 2, default = None, metavar = ('OLD', 'NEW'))
+    parser.add_argument('--threshold', type = float, default = .1)
+    parser.add_argument('--warm', default = False, action = 'store_true', 
+            help = 'keep line indexes and caches between runs, to time repeat runs on the same data')
+    # used internally, to run a single benchmark in its own process
+    parser.add_argument('--run_one', default = None)
+    parser.add_argument('--text', default = None)
+    parser.add_argument('--int', default = None)
+    return parser.parse_args()
+
+
+#===============================================================================
+# SCRIPT
+#===============================================================================
+
+if __name__ == '__main__':
+    args = get_args()
+
+    if args.run_one:
+        print json.dumps(run_one(args.run_one, args.text, args.int, args.warm))
+        sys.exit(0)
+
+    if args.compare:
+        sys.exit(1 if compare(args.compare[0], args.compare[1], args.threshold) else 0)
+
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='bench_data_')
+    if not os.path.exists(data_dir):
+        os.makedirs(data_dir)
+    text_fname = os.path.join(data_dir, 'text_%s_%s.txt'%(args.n_lines, args.line_length))
+    int_fname = os.path.join(data_dir, 'int_%s_%s.txt'%(args.n_lines, args.line_length))
+    # the data only depends on the arguments, so it is reused if it is already there
+    for fname, content in [(text_fname, 'text'), (int_fname, 'int')]:
+        if not os.path.exists(fname):
+            make_synthetic_file(fname, args.n_lines, args.line_length, content)
+
+    names = args.only or [bench.__name__ for bench in BENCHMARKS]
+    results = run_all(text_fname, int_fname, names, args.repeat, args.warm)
+    with open(args.output, 'w') as f:
+        json.dump({'commit': git_commit(), 'time': gu.time_string('second'),
+                'n_lines': args.n_lines, 'line_length': args.line_length, 'warm': args.warm, 
+                'results': results}, f, indent = 2)
+    if not args.data_dir:
+        shutil.rmtree(data_dir, ignore_errors=True)
@@ -26,9 +26,16 @@
 # COSMETIC:
 #-------------------------------------------------------------------------------
 # colorprint: prints the given text in the given color
+# Progress: reports bytes/lines processed, rate, ETA and phase timings of the
+#       file functions, as a terminal meter, JSON, or to a callback.
 # time_string:
 #       returns a string representing the date in the form '12-Jul-2013' etc.
 #       Handy naming of files.
+# timer, timed: a context manager and decorator which record how long named
+#       sections of code take, in the TimingRegistry TIMINGS.  TIMINGS.report()
+#       prints calls, total, mean and p95 times as a table.
+# check_import_time: checks that importing this module stays fast (numpy,
+#       matplotlib etc are only imported when first used).
 #-------------------------------------------------------------------------------
 # FOR (LARGE) FILES:
 #-------------------------------------------------------------------------------
@@ -42,9 +49,40 @@
 #       Useful if you are doing SGD, for instance.
 # file_generator:
 #       streams a file line by line, and processes that line as a list of integers.
+# file_batch_generator:
+#       streams a file of numbers as numpy arrays, many lines at a time.
+# cache_file: saves a file of numbers in a binary format which file_generator
+#       and file_batch_generator then memory-map instead of parsing the text.
+# open_file: like open(), but reads and writes .gz, .bz2 and .xz files
+#       transparently.  Used by all of the file functions.
+# add_header: prepends a header line to a file (or list of files), atomically.
+# parallel_map_file: maps (and optionally reduces) a function over the lines of
+#       a file with a process pool, each worker taking a byte range of the file.
+# LineIndex: random access to the lines of a large file by line number, backed
+#       by a sidecar file of line offsets that is only rebuilt when the file changes.
+# AlignedReader: reads parallel files (e.g. features and targets) in lock-step,
+#       in large blocks, and checks that they have the same number of lines.
+# FileCache: reuses the samples, scrambled files and splits made from unchanged
+#       inputs with the same arguments, instead of making them again.
+# sort_file: sorts (and optionally deduplicates) a file by a key column, out of
+#       core with an external merge sort if it doesn't fit in memory.
+# MinibatchLoader: streams shuffled numpy minibatches from aligned feature and
+#       target files, reshuffled every epoch, with background prefetching.
 # split_file: given the name of some unnecessarily large file that you have to 
 #       work with, original_fname, this function splits it into a bunch of
-#       smaller files that you can then do multithreaded operations on.
+#       smaller files that you can then do multithreaded operations on.  Can
+#       split by line count or, in parallel, by newline-aligned byte ranges, or
+#       shard by a stable hash of a key column.
+#-------------------------------------------------------------------------------
+# FOR TEXT:
+#-------------------------------------------------------------------------------
+# str_parse: splits a string into lowercase words, dropping punctuation.
+#       str_parse_many and str_parse_file do the same for many strings/lines.
+# build_vocabulary: counts the words in (large) files, in parallel.
+# encode_file: rewrites a text file as the vocabulary ids of its words, in the
+#       format file_generator reads.
+# CountMinSketch: approximate counts and top k of a stream in fixed memory.
+#       sketch_vocabulary builds one over (large) files, in parallel.
 #
 #===============================================================================
 # TODO: 
@@ -52,18 +90,56 @@
 
 
 #standard modules
-import numpy as np
 import time
 from collections import Counter, defaultdict
 import heapq
-import matplotlib.pyplot as plt
-import argparse
 import shutil
 import csv
 import os
 import re
 import collections
 import json
+import sys
+import itertools
+import importlib
+import functools
+import random
+import hashlib
+import struct
+import threading
+import Queue
+import gzip
+import bz2
+try:
+    import lzma # python 3, or the backports.lzma package
+except ImportError:
+    lzma = None
+
+
+class _LazyModule(object):
+    """stands in for a module which is slow to import (numpy, matplotlib, ...) until an 
+    attribute of it is first used, so that importing generic_util is fast, e.g. in 
+    process pool workers and cron jobs that only need split_file or str_parse.  On first
+    use the module is imported and replaces this proxy in the module namespace.
+    """
+    def __init__(self, name, alias):
+        self._name = name
+        self._alias = alias
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._name)
+        globals()[self._alias] = module
+        return getattr(module, attr)
+
+# heavy modules, imported the first time they are used
+np = _LazyModule('numpy', 'np')
+plt = _LazyModule('matplotlib.pyplot', 'plt')
+argparse = _LazyModule('argparse', 'argparse')
+multiprocessing = _LazyModule('multiprocessing', 'multiprocessing')
+tempfile = _LazyModule('tempfile', 'tempfile')
+
+# the modules which importing generic_util must not pull in; see check_import_time
+_LAZY_MODULES = ['numpy', 'matplotlib', 'argparse', 'multiprocessing', 'tempfile']
 
 
 #===============================================================================
@@ -71,93 +147,355 @@ import json
 #===============================================================================
 
 
-def add_header(fname, header):
-    tmp_fname = 'loltempfile'
+def open_file(fname, mode = 'r', compression = 'infer', prefetch = True):
+    """opens fname like open(), except that .gz, .bz2 and .xz files are transparently 
+    decompressed when read and compressed when written.  All of the file functions in 
+    this module open their files with this.
+
+    compression: 'infer' (from the first bytes of the file when reading, or from the 
+        extension when writing), None, 'gzip', 'bz2' or 'xz'.
+    prefetch: if set, compressed files are decompressed on a background thread, so 
+        that decompressing overlaps with whatever is done with the lines.
+
+    Usage:
+    with open_file("data/words_stream.txt.gz") as f:
+        for line in f:
+            ...
+    """
+    if compression == 'infer':
+        compression = _infer_compression(fname, mode)
+    if compression is None:
+        return open(fname, mode)
+    if compression not in _COMPRESSION_SUFFIXES:
+        raise ValueError('unknown compression %s'%compression)
+    if compression == 'xz' and lzma is None:
+        raise ImportError('reading and writing .xz files needs the lzma module (python 3, or backports.lzma)')
+    opener = {'gzip': gzip.open, 'bz2': bz2.BZ2File, 'xz': lzma.open if lzma else None}[compression]
+    if 'r' in mode:
+        f = opener(fname, 'rb')
+        return _PrefetchReader(f) if prefetch else f
+    return opener(fname, 'ab' if 'a' in mode else 'wb')
+
+
+def add_header(fname, header, n_workers = None):
+    """prepends the line header to the file fname.  The new file is written to a 
+    uniquely named temporary file in the same directory and then renamed over the 
+    original, so the original is intact if this is interrupted, and concurrent calls 
+    don't clobber each other's temporary files.
+
+    If fname is a list, the same header is added to all of the files, by a pool of 
+    n_workers processes.
+
+    Usage:
+    add_header('data/clean_mail_test.tsv', 'Subject   Delivered-To    Received')
+    """
     if header[-1] != '\n':
         header += '\n'
-    shutil.copyfile(fname, tmp_fname)
-    with open(fname, 'w') as f:
-        f.write(header)
-        with open(tmp_fname, 'r') as g:
-            for line in g:
-                f.write(line)
-    os.remove(tmp_fname)
-
- 
-def split_file(original_fname, output_dir_fname, n_splits = 15, delimitor = '\n'):
+    if isinstance(fname, list):
+        _map_jobs(_add_header_job, [(fname_i, header) for fname_i in fname], n_workers)
+    else:
+        _add_header_job((fname, header))
+
+
+def split_file(original_fname, output_dir_fname, n_splits = 15, delimitor = '\n', mode = 'lines', n_workers = None, compression = None, \
+        progress = None, key = None, column_delimitor = '\t', seed = None, buffer_size = 64 << 20):
     """given the name of some unnecessarily large file that you have to work with, original_fname,
     this function splits it into a bunch of smaller files that you can then do multithreaded 
-    operations on.
+    operations on.  At most n_splits files are written, named split_0, split_1, etc.
+
+    mode = 'lines' makes every shard have (nearly) the same number of lines.  The line 
+        count and shard boundaries come from the file's LineIndex, so this is fast on 
+        repeat runs, and the shards are also written by a pool of n_workers processes.
+    mode = 'bytes' makes every shard have (nearly) the same number of bytes.  The shard 
+        boundaries are found from the file size by seeking and scanning to the next 
+        delimitor, so there is no counting pass, and the shards are written concurrently 
+        by a pool of n_workers processes (default: one per cpu).
+    mode = 'key' sends every line to the shard picked by a stable hash of its key, so all 
+        the lines with the same key (e.g. a user id) end up in the same shard, on every 
+        run.  If key is None the whole line is hashed; if it is an int, that column (split 
+        on column_delimitor); if it is a function, key(line).  seed, if given, salts the 
+        hash.  The file is read once, and the lines are buffered in memory (buffer_size 
+        bytes in all) and appended to their shards a buffer at a time, so only one shard 
+        is open at once, and there can be thousands of shards.  All n_splits shards are 
+        written, some possibly empty.
+
+    compression: if 'gzip', 'bz2' or 'xz', the shards are compressed (and named split_0.gz, 
+        etc).  Compressed input files can't be seeked in, so they are only supported in 
+        'lines' mode, where they are read sequentially, twice, and in 'key' mode.  In 
+        'key' mode each buffer is appended as a new compressed stream, which bz2 can't do.
+
+    progress: reports how far along this is; see Progress.
 
     Usage: split_file('./data/words_stream.txt', './data/words_stream_split_15')
+    split_file('./data/big_log.txt', './data/big_log_split', n_splits = 64, mode = 'bytes')
+    split_file('./data/mail.tsv', './data/mail_by_user', n_splits = 1000, mode = 'key', key = 0)
 
     """
+    assert(mode in ('lines', 'bytes', 'key'))
     if not os.path.exists(output_dir_fname):
         os.makedirs(output_dir_fname)
-
-    lines_in_file = 0
-    with open(original_fname, 'r') as f:
-        for line in f:
-            lines_in_file += 1
-
-    lines_per_subfile = lines_in_file/n_splits
-
-    with open(original_fname, 'r') as input_f:
-        cur_split = 0
-        output_f = open(output_dir_fname + '/split_%s'%cur_split, 'w')
-        for i, line in enumerate(input_f):
-            if i%lines_per_subfile == 0 and i:
-                cur_split += 1
-                output_f.close()
-                output_f = open(output_dir_fname + '/split_%s'%cur_split, 'w')
-            output_f.write(line)
-
-        output_f.close()
-
-
-def make_dev_train_sets(original_fname, names, percents, scramble = False, preserve_header = 0):
+    shard_fname = output_dir_fname + '/split_%s' + _COMPRESSION_SUFFIXES.get(compression, '')
+    progress = _make_progress(progress, 'split_file')
+    size = os.path.getsize(original_fname)
+
+    if mode == 'key':
+        if compression == 'bz2':
+            raise ValueError("bz2 shards can't be appended to, so they can't be written with mode = 'key'")
+        key_fn = _line_key_function(key, column_delimitor)
+        salt = '' if seed is None else '%s:'%seed
+        progress.start_phase('write', size)
+        with open_file(original_fname, 'r') as input_f:
+            with _ShardWriter([shard_fname%i for i in range(n_splits)], buffer_size, compression) as writer:
+                for line in progress.iter_lines(input_f):
+                    writer.write(int(_stable_unit_hash(key_fn(line), salt)*n_splits), line)
+        progress.finish()
+        return
+
+    if _infer_compression(original_fname, 'r'):
+        if mode != 'lines':
+            raise ValueError("compressed files can only be split with mode = 'lines'")
+        lines_in_file = _count_lines(original_fname, progress)
+        lines_per_subfile = max(1, -(-lines_in_file//n_splits))
+        progress.start_phase('write')
+        with open_file(original_fname, 'r') as input_f:
+            cur_split = 0
+            output_f = open_file(shard_fname%cur_split, 'w')
+            for i, line in enumerate(progress.iter_lines(input_f)):
+                if i%lines_per_subfile == 0 and i:
+                    cur_split += 1
+                    output_f.close()
+                    output_f = open_file(shard_fname%cur_split, 'w')
+                output_f.write(line)
+            output_f.close()
+        progress.finish()
+        return
+
+    if mode == 'bytes':
+        ranges = _byte_ranges(original_fname, n_splits, delimitor)
+        jobs = [(original_fname, start, end, shard_fname%i) \
+                for i, (start, end) in enumerate(ranges)]
+    else:
+        progress.start_phase('count', size)
+        with LineIndex(original_fname, progress = progress) as index:
+            lines_in_file = len(index)
+            # round up, so that the remainder doesn't spill into an extra tiny shard
+            lines_per_subfile = max(1, -(-lines_in_file//n_splits))
+            starts = range(0, lines_in_file, lines_per_subfile) or [0]
+            jobs = [(original_fname, index.offset(i), index.offset(min(i + lines_per_subfile, lines_in_file)), \
+                    shard_fname%cur_split) for cur_split, i in enumerate(starts)]
+
+    progress.start_phase('write', size)
+    for job, _ in itertools.izip(jobs, _imap_jobs(_copy_byte_range, jobs, n_workers)):
+        progress.advance(job[2] - job[1])
+    progress.finish()
+
+
+def parallel_map_file(fname, map_fn, reduce_fn = None, n_workers = None, output_fname = None, preserve_order = True, n_ranges = None, \
+        initializer = None, initargs = ()):
+    """applies map_fn to every line of fname, using a pool of n_workers processes (default:
+    one per cpu), each of which works on its own newline-aligned byte range of the file.  
+    No shard files are written; this replaces split_file followed by a script per shard.
+
+    If reduce_fn is given, the mapped values are combined with it (it must be associative,
+    since each worker first reduces its own range) and the result is returned.
+    If output_fname is given, map_fn should return the transformed line (or None to drop 
+    the line), and the transformed lines are written to output_fname.  If preserve_order 
+    is False, the ranges are written out in whatever order they finish.
+    Otherwise the list of all mapped values is returned, in file order.
+
+    map_fn and reduce_fn are sent to the worker processes, so they must be module level 
+    functions (not lambdas).  If map_fn needs some large state, set it up in a module 
+    global with initializer(*initargs), which is called once in every worker.  The file 
+    can't be compressed.
+
+    Usage:
+    def n_words(line): return len(line.split())
+    def add(a, b): return a + b
+    total_words = parallel_map_file('./data/words_stream.txt', n_words, add)
+
+    parallel_map_file('./data/mail.tsv', clean_line, output_fname = './data/clean_mail.tsv')
     """
-    TODO: extend to take lists of files as input. 
+    if _infer_compression(fname, 'r'):
+        raise ValueError('compressed files can\'t be split into byte ranges')
+    if n_workers is None:
+        n_workers = multiprocessing.cpu_count()
+    if n_ranges is None:
+        # more ranges than workers, so that a slow range doesn't hold up the whole pool
+        n_ranges = 4*n_workers
+    ranges = _byte_ranges(fname, n_ranges)
+
+    if output_fname is None:
+        jobs = [(fname, start, end, map_fn, reduce_fn, None) for start, end in ranges]
+        results = _map_jobs(_map_reduce_range, jobs, n_workers, initializer, initargs)
+        if reduce_fn is None:
+            return [value for values in results for value in values]
+        results = [value for nonempty, value in results if nonempty]
+        return reduce(reduce_fn, results) if results else None
+
+    part_dir = tempfile.mkdtemp(prefix='parallel_map_', dir=os.path.dirname(os.path.abspath(output_fname)))
+    try:
+        jobs = [(fname, start, end, map_fn, None, os.path.join(part_dir, 'part_%s'%i)) \
+                for i, (start, end) in enumerate(ranges)]
+        pool = multiprocessing.Pool(min(n_workers, len(jobs)), initializer, initargs) \
+                if n_workers > 1 and len(jobs) > 1 else None
+        try:
+            if pool is None:
+                if initializer is not None:
+                    initializer(*initargs)
+                part_fnames = itertools.imap(_map_reduce_range, jobs)
+            elif preserve_order:
+                part_fnames = pool.imap(_map_reduce_range, jobs)
+            else:
+                part_fnames = pool.imap_unordered(_map_reduce_range, jobs)
+            with open_file(output_fname, 'wb') as output_f:
+                for part_fname in part_fnames:
+                    with open(part_fname, 'rb') as part_f:
+                        shutil.copyfileobj(part_f, output_f, COPY_BLOCK_SIZE)
+                    os.remove(part_fname)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+    finally:
+        shutil.rmtree(part_dir, ignore_errors=True)
+
+
+def make_dev_train_sets(original_fname, names, percents, scramble = False, preserve_header = 0, \
+        assign = None, seed = None, key = None, column_delimitor = '\t', progress = None, cache = None):
+    """splits original_fname into len(names) files, such that names[k] gets (about) 
+    percents[k] of the lines.
+
+    By default the splits are contiguous blocks of the file (of the scrambled file, if 
+    scramble is set).  If assign is given, the lines are instead streamed in a single pass 
+    and each line is sent to a split on its own (scramble is then not needed):
+    assign = 'random' draws the split of each line at random (reproducibly, given seed).
+    assign = 'hash' picks the split from a stable hash of the line, so a line always lands
+        in the same split across reruns and after data is appended to the file.  If key is 
+        an int, only that column (split on column_delimitor) is hashed, e.g. a user id; if 
+        it is a function, key(line) is hashed.  seed, if given, salts the hash.
+
+    In the streaming modes original_fname may also be a list of aligned files (e.g. 
+    features and targets), in which case names[k] is the list of output files for split k, 
+    and the key is computed from the first file.
+
+    seed: if given, the scramble and assign = 'random' are reproducible.
+
+    Inputs and outputs ending in .gz, .bz2 or .xz are read and written compressed.
+
+    progress: reports how far along this is; see Progress.
+
+    cache: a FileCache (or True, for the default one) in which to look up the splits made 
+        from the same input with the same arguments before, instead of making them again.
+        Only used when the result is reproducible, i.e. scramble and assign = 'random' 
+        need a seed, and key can't be a function.
+
+    Usage:
+    make_dev_train_sets("data/mail.tsv", ["data/train.tsv", "data/dev.tsv"], [.8, .2], scramble = True)
+
+    make_dev_train_sets(["data/features.txt", "data/target.txt"], 
+        [["data/train_features.txt", "data/train_target.txt"], ["data/dev_features.txt", "data/dev_target.txt"]],
+        [.9, .1], assign = 'hash', key = 0, column_delimitor = ' ')
+
+    TODO: extend the contiguous mode to take lists of files as input. 
     """
     assert(abs(sum(percents) - 1) < 1e-5)
     assert(len(names) == len(percents))
+    assert(assign in (None, 'random', 'hash'))
+
+    cache = _get_file_cache(cache)
+    is_random = scramble if assign is None else assign == 'random'
+    if cache is not None and (seed is not None or not is_random) and not callable(key):
+        inputs = original_fname if isinstance(original_fname, list) else [original_fname]
+        outputs = [fname for names_k in names for fname in (names_k if isinstance(names_k, list) else [names_k])]
+        params = [percents, scramble, preserve_header, assign, seed, key, column_delimitor]
+        cache.fetch_or_run('make_dev_train_sets', inputs, outputs, params, lambda: make_dev_train_sets(original_fname, \
+                names, percents, scramble, preserve_header, assign, seed, key, column_delimitor, progress))
+        return
+
+    progress = _make_progress(progress, 'make_dev_train_sets')
+    if assign is not None:
+        _stream_dev_train_sets(original_fname, names, percents, preserve_header, assign, seed, key, column_delimitor, progress)
+        progress.finish()
+        return
 
     if scramble:
-        scramble_file_lines(original_fname, original_fname  + '.scrambled', keep_first_line_first = preserve_header)
+        scramble_file_lines(original_fname, original_fname  + '.scrambled', keep_first_line_first = preserve_header, \
+                progress = progress, seed = seed)
         original_fname = original_fname  + '.scrambled'
 
-    lines_in_file = 0
+    lines_in_file = _count_lines(original_fname, progress)
     header = None
-    with open(original_fname, 'r') as f:
-        for i, line in enumerate(f):
-            if not i and preserve_header:
-                header = line
-            lines_in_file += 1
+    if preserve_header and lines_in_file:
+        with open_file(original_fname, 'r') as input_f:
+            header = input_f.readline()
 
     lines_per_split = [p*lines_in_file for p in percents]
     lines_per_split = [np.ceil(n) for n in lines_per_split]
 
-    with open(original_fname, 'r') as input_f:
+    progress.start_phase('write', os.path.getsize(original_fname))
+    with open_file(original_fname, 'r') as input_f:
         cur_split = 0
-        output_f = open(names[0], 'w')
+        output_f = open_file(names[0], 'w')
         i = 0
         if preserve_header:
             input_f.readline()
-        for line in input_f:
+        for line in progress.iter_lines(input_f):
             if i%lines_per_split[cur_split] == 0 and i:
                 cur_split += 1
                 i=0
                 output_f.close()
-                output_f = open(names[cur_split], 'w')
+                output_f = open_file(names[cur_split], 'w')
                 if preserve_header:
                     output_f.write(header)
             output_f.write(line)
             i += 1
 
         output_f.close()
+    progress.finish()
 
 
-def randomly_sample_file(original_fname, output_fname, n_lines_to_output = 100, delimitor = '\n', preserve_first_line = 1):
+def _stream_dev_train_sets(original_fname, names, percents, preserve_header, assign, seed, key, column_delimitor, progress):
+    """the single pass version of make_dev_train_sets."""
+    if not isinstance(original_fname, list):
+        original_fname = [original_fname]
+        names = [[name] for name in names]
+    assert(all(len(names_k) == len(original_fname) for names_k in names))
+
+    bounds = np.cumsum(percents)
+    def split_of(u):
+        return min(int(np.searchsorted(bounds, u, side='right')), len(bounds) - 1)
+
+    if assign == 'hash':
+        salt = '' if seed is None else '%s:'%seed
+        key_fn = _line_key_function(key, column_delimitor)
+        def assign_batch(rows):
+            return [split_of(_stable_unit_hash(key_fn(row[0]), salt)) for row in rows]
+    else:
+        rng = np.random.RandomState(seed)
+        def assign_batch(rows):
+            return np.minimum(np.searchsorted(bounds, rng.random_sample(len(rows)), side='right'), len(bounds) - 1)
+
+    progress.start_phase('write', sum(os.path.getsize(fname) for fname in original_fname))
+    output_fs = [[open_file(fname, 'w') for fname in names_k] for names_k in names]
+    try:
+        with AlignedReader(original_fname, progress = progress) as reader:
+            if preserve_header:
+                headers = reader.readrow()
+                if headers is not None:
+                    for outputs_k in output_fs:
+                        for output_f, header in zip(outputs_k, headers):
+                            output_f.write(header)
+            for batch in reader.chunks():
+                for k, row in itertools.izip(assign_batch(batch), batch):
+                    for output_f, line in zip(output_fs[k], row):
+                        output_f.write(line)
+    finally:
+        for f in [f for outputs_k in output_fs for f in outputs_k]:
+            f.close()
+
+
+def randomly_sample_file(original_fname, output_fname, n_lines_to_output = 100, delimitor = '\n', preserve_first_line = 1, mode = 'index', seed = None, \
+        progress = None, cache = None):
     """given the name of some unnecessarily large file that you have to work with, original_fname,
     randomly samples it to have n_lines_to_output.  This function is used for when you want to
     do some testing of your script on a pared down file first.
@@ -165,6 +503,20 @@ def randomly_sample_file(original_fname, output_fname, n_lines_to_output = 100,
     if original_fname is a list, then all files are sampled evenly  (the same lines are taken from 
     each one.)
 
+    mode = 'index' seeks to the sampled lines using the file's LineIndex, which is fastest
+        when the index already exists.
+    mode = 'reservoir' reads the file(s) once with reservoir sampling (Algorithm L), skipping 
+        over most lines without keeping them, and only ever holds n_lines_to_output lines in 
+        memory.  Use this for one-off samples of huge files.  Compressed files are always
+        sampled this way, since they can't be indexed.
+
+    seed: if given, the sample is reproducible.
+
+    progress: reports how far along this is; see Progress.
+
+    cache: a FileCache (or True, for the default one) in which to look up a sample made 
+        from the same input with the same arguments before.  Only used if seed is given.
+
     Usage: 
     randomly_sample_file(["./data/features.txt", "./data/target.txt"], ["./data/dev_features.txt", "./data/dev_target.txt"], 200)
 
@@ -177,33 +529,85 @@ def randomly_sample_file(original_fname, output_fname, n_lines_to_output = 100,
     else:
         original_fname = [original_fname]
         output_fname = [output_fname]
+    assert(mode in ('index', 'reservoir'))
+    cache = _get_file_cache(cache)
+    if cache is not None and seed is not None:
+        cache.fetch_or_run('randomly_sample_file', original_fname, output_fname, \
+                [n_lines_to_output, preserve_first_line, mode, seed], lambda: randomly_sample_file(original_fname, \
+                output_fname, n_lines_to_output, delimitor, preserve_first_line, mode, seed, progress))
+        return
+    rng = np.random.RandomState(seed) if seed is not None else np.random
+    if any(_infer_compression(fname, 'r') for fname in original_fname):
+        mode = 'reservoir'
+    progress = _make_progress(progress, 'randomly_sample_file')
+
+    if mode == 'reservoir':
+        progress.start_phase('sample', sum(os.path.getsize(fname) for fname in original_fname))
+        with AlignedReader(original_fname, progress = progress) as reader:
+            headers = reader.readrow() if preserve_first_line and n_lines_to_output else None
+            sample = _reservoir_sample(reader, n_lines_to_output - (headers is not None), rng)
+        for i, output_fname_i in enumerate(output_fname):
+            with open_file(output_fname_i, 'w') as output_i:
+                if headers is not None:
+                    output_i.write(headers[i])
+                for j, row in sample:
+                    output_i.write(row[i])
+        progress.finish()
+        return
+
+    progress.start_phase('count', sum(os.path.getsize(fname) for fname in original_fname))
+    lines_in_files = []
+    for fname in original_fname:
+        with LineIndex(fname, progress = progress) as index:
+            lines_in_files.append(len(index))
+    if len(set(lines_in_files)) > 1:
+        raise ValueError('the files have different numbers of lines: %s'% \
+                ', '.join('%s (%s)'%pair for pair in zip(original_fname, lines_in_files)))
+    lines_in_file = lines_in_files[0]
+
+    n_lines_to_output = min(n_lines_to_output, lines_in_file)
+    if preserve_first_line and n_lines_to_output:
+        line_idxs_to_output = [0] + _sample_indices(1, lines_in_file, n_lines_to_output - 1, rng)
+    else:
+        line_idxs_to_output = _sample_indices(0, lines_in_file, n_lines_to_output, rng)
+    line_idxs_to_output.sort()
 
-
-    lines_in_file = 0
-    with open(original_fname[0], 'r') as f:
-        for line in f:
-            lines_in_file += 1
-
-    line_idxs_to_output = range(lines_in_file)[1:] if preserve_first_line else np.arange(lines_in_file)
-    np.random.shuffle(line_idxs_to_output)
-    if preserve_first_line: line_idxs_to_output = [0] + line_idxs_to_output
-    line_idxs_to_output = set(line_idxs_to_output[0:n_lines_to_output])
-
+    progress.start_phase('write')
     for input_fname_i, output_fname_i in zip(original_fname, output_fname): 
-        with open(input_fname_i, 'r') as input_i, open(output_fname_i, 'w') as output_i:
-            for j, line in enumerate(input_i):
-                if j in line_idxs_to_output:
-                    output_i.write(line)
+        with LineIndex(input_fname_i) as input_i, open_file(output_fname_i, 'w') as output_i:
+            for j in line_idxs_to_output:
+                output_i.write(input_i[j])
+        progress.advance(0, len(line_idxs_to_output))
+    progress.finish()
 
 
-def scramble_file_lines(original_fname, output_fname, delimitor = '\n', keep_first_line_first = 0):
+def scramble_file_lines(original_fname, output_fname, delimitor = '\n', keep_first_line_first = 0, memory_budget = None, tmp_dir = None, \
+        progress = None, seed = None, cache = None):
     """randomly permutes the lines in the input file.  If the input 
     file is a list, permutes all lines in the iput files in the same way.
-    Useful if you are doing SGD, for instance.
+    Useful if you are doing SGD, for instance (though MinibatchLoader reshuffles 
+    every epoch without writing a copy).
+
+    memory_budget: roughly how many bytes of input may be held in memory at once.  If the
+        input is bigger than this, the shuffle is done out of core: lines are scattered 
+        at random into temporary bucket files (in tmp_dir, by default next to the first 
+        output file), and each bucket is then shuffled in memory and appended to the 
+        output.  By default everything is shuffled in memory.  (For compressed inputs, the 
+        budget is compared with the compressed size.)
+
+    progress: reports how far along this is; see Progress.
+
+    seed: if given, the permutation is reproducible (for a given memory_budget).
+
+    cache: a FileCache (or True, for the default one) in which to look up the scrambled 
+        files made from the same input with the same arguments before.  Only used if seed 
+        is given.
 
     Usage: 
     scramble_file_lines([X_FILENAME, Y_FILENAME], ["./data/scrambled_features.txt", "./data/scrambled_target.txt"])
 
+    scramble_file_lines("data/huge.tsv", "data/huge_scrambled.tsv", memory_budget = 2*10**9)
+
     """
     assert(type(original_fname) == type(output_fname))
     if isinstance(original_fname, list):
@@ -212,44 +616,1664 @@ def scramble_file_lines(original_fname, output_fname, delimitor = '\n', keep_fir
         original_fname = [original_fname]
         output_fname = [output_fname]
 
+    cache = _get_file_cache(cache)
+    if cache is not None and seed is not None:
+        cache.fetch_or_run('scramble_file_lines', original_fname, output_fname, \
+                [keep_first_line_first, memory_budget, seed], lambda: scramble_file_lines(original_fname, \
+                output_fname, delimitor, keep_first_line_first, memory_budget, tmp_dir, progress, seed))
+        return
+
+    rng = np.random.RandomState(seed) if seed is not None else np.random
+    total_size = sum(os.path.getsize(fname) for fname in original_fname)
+    progress = _make_progress(progress, 'scramble_file_lines')
+    if memory_budget is not None and total_size > memory_budget:
+        _external_scramble(original_fname, output_fname, keep_first_line_first, \
+                memory_budget, total_size, tmp_dir, progress, rng)
+        progress.finish()
+        return
+
+    progress.start_phase('read', total_size)
+    with AlignedReader(original_fname, progress = progress) as reader:
+        headers = reader.readrow() if keep_first_line_first else None
+        lines = list(reader) #lines[i] is a tuple of the i-th line of every file
+
+    progress.start_phase('shuffle')
+    rng.shuffle(lines)
+
+    progress.start_phase('write')
+    for i, output_fname_i in enumerate(output_fname): 
+        with open_file(output_fname_i, 'w') as output_i:
+            if headers is not None:
+                output_i.write(headers[i])
+            _write_lines(output_i, [line[i] for line in lines])
+        progress.advance(0, len(lines))
+    progress.finish()
 
-    lines = [] #lines[i] is a list of lines
-    headers = []
-    for input_i in original_fname:
-        with open(input_i, 'r') as f:
-            if keep_first_line_first:
-                headers.append(f.readline())
-            for i, line in enumerate(f):
-                if len(lines) == i:
-                    lines.append([])
-                lines[i].append(line)
 
-    np.random.shuffle(lines)
+def _external_scramble(original_fname, output_fname, keep_first_line_first, memory_budget, total_size, tmp_dir, progress, rng):
+    """the out of core version of scramble_file_lines.  Rows (the i-th line of every input 
+    file) are each sent to one of n_buckets random temporary files, so that a bucket fits 
+    in memory_budget; shuffling every bucket and concatenating them gives a uniformly 
+    random permutation of the rows.  The buckets are written through a _ShardWriter, so 
+    they aren't all open at once however many there are.
+    """
+    n_files = len(original_fname)
+    # leave headroom, since the buckets aren't all exactly the same size
+    n_buckets = max(2, int(np.ceil(2.*total_size/memory_budget)))
+    if tmp_dir is None:
+        tmp_dir = os.path.dirname(os.path.abspath(output_fname[0]))
+    bucket_dir = tempfile.mkdtemp(prefix='scramble_', dir=tmp_dir)
+    try:
+        bucket_fnames = [os.path.join(bucket_dir, 'bucket_%s'%b) for b in range(n_buckets)]
+        progress.start_phase('scatter', total_size)
+        # the buffered rows count against the budget too
+        with _ShardWriter(bucket_fnames, min(memory_budget//2, 64 << 20) or 1) as buckets, \
+                AlignedReader(original_fname, progress = progress) as reader:
+            headers = reader.readrow() if keep_first_line_first else None
+            # the lines of each row are written consecutively, so each must end in a newline
+            for batch in reader.chunks():
+                for b, row in itertools.izip(rng.randint(n_buckets, size=len(batch)), batch):
+                    text = ''.join(row)
+                    if text.count('\n') != n_files:
+                        text = ''.join(line if line.endswith('\n') else line + '\n' for line in row)
+                    buckets.write(b, text)
+
+        progress.start_phase('gather', sum(os.path.getsize(fname) for fname in bucket_fnames))
+        output_fs = [open_file(fname, 'w') for fname in output_fname]
+        try:
+            if headers is not None:
+                for output_i, header in zip(output_fs, headers):
+                    output_i.write(header)
+            for bucket_fname in bucket_fnames:
+                with open(bucket_fname, 'r') as f:
+                    lines = f.readlines()
+                progress.advance(os.path.getsize(bucket_fname), len(lines)//n_files)
+                os.remove(bucket_fname)
+                for j in rng.permutation(len(lines)//n_files):
+                    for i, output_i in enumerate(output_fs):
+                        output_i.write(lines[j*n_files + i])
+        finally:
+            for f in output_fs:
+                f.close()
+    finally:
+        shutil.rmtree(bucket_dir, ignore_errors=True)
+
+
+def sort_file(original_fname, output_fname, key = None, column_delimitor = '\t', numeric = False, unique = False, \
+        preserve_header = 0, memory_budget = None, n_workers = 1, tmp_dir = None, progress = None):
+    """sorts the lines of original_fname into output_fname.  The sort is stable, so 
+    lines with the same key stay in the order they were in.
+
+    key: what to sort by: the whole line if None, the column key (split on 
+        column_delimitor) if it is an int, or key(line) if it is a function.
+    numeric: compare the keys as numbers rather than as strings (an empty key is 0).
+    unique: keep only the first line of every run of lines with the same key (with the 
+        default key, this removes duplicate lines).
+    preserve_header: keep the first line first.
+
+    memory_budget: roughly how many bytes of input may be held in memory at once.  If the 
+        input is bigger than this, it is sorted out of core: it is read in runs of about 
+        memory_budget bytes, each run is sorted and spilled to a temporary file (in tmp_dir, 
+        by default next to the first output file), and the runs are then merged.  If 
+        n_workers > 1, the runs are sorted by a pool of that many processes; key must then 
+        be a module level function (not a lambda), if it is a function.  By default 
+        everything is sorted in memory.
+
+    If original_fname is a list of aligned files (e.g. features and targets), the rows 
+    of all of them are sorted together, by the key of the line in the first file, and 
+    output_fname must be a list too.
+
+    Every output line ends in a newline, even if the last input line didn't.
+
+    progress: reports how far along this is; see Progress.
+
+    Usage:
+    sort_file("data/mail.tsv", "data/mail_by_sender.tsv", key = 1, preserve_header = 1)
+
+    sort_file("data/words_stream.txt", "data/words_unique.txt", unique = True, memory_budget = 10**9)
+    """
+    assert(type(original_fname) == type(output_fname))
+    if isinstance(original_fname, list):
+        assert(len(original_fname) == len(output_fname))
+    else:
+        original_fname = [original_fname]
+        output_fname = [output_fname]
+    n_files = len(original_fname)
+    key_spec = (key, column_delimitor, numeric)
+
+    progress = _make_progress(progress, 'sort_file')
+    progress.start_phase('read', sum(os.path.getsize(fname) for fname in original_fname))
+    if tmp_dir is None:
+        tmp_dir = os.path.dirname(os.path.abspath(output_fname[0]))
+    run_dir = None
+    try:
+        run_fnames = []
+        with AlignedReader(original_fname, progress = progress) as reader:
+            headers = reader.readrow() if preserve_header else None
+            rows, run_size = [], 0
+            for chunk in reader.chunks():
+                rows.extend(chunk)
+                run_size += sum(len(line) for row in chunk for line in row)
+                if memory_budget is not None and run_size >= memory_budget:
+                    if run_dir is None:
+                        run_dir = tempfile.mkdtemp(prefix='sort_', dir=tmp_dir)
+                    run_fnames.append(os.path.join(run_dir, 'run_%s'%len(run_fnames)))
+                    if n_workers == 1:
+                        rows = _sort_rows(rows, key_spec, unique)
+                    _write_rows(rows, run_fname = run_fnames[-1])
+                    rows, run_size = [], 0
+
+        output_fs = [open_file(fname, 'w') for fname in output_fname]
+        try:
+            if headers is not None:
+                for output_i, header in zip(output_fs, headers):
+                    output_i.write(header if header.endswith('\n') else header + '\n')
+            if not run_fnames:
+                progress.start_phase('sort')
+                _write_rows(_sort_rows(rows, key_spec, unique), output_fs)
+            else:
+                if rows:
+                    run_fnames.append(os.path.join(run_dir, 'run_%s'%len(run_fnames)))
+                    _write_rows(_sort_rows(rows, key_spec, unique), run_fname = run_fnames[-1])
+                    rows = None
+                if n_workers != 1:
+                    progress.start_phase('sort')
+                    jobs = [(fname, n_files, key_spec, unique) for fname in run_fnames]
+                    for _ in _imap_jobs(_sort_run, jobs, n_workers):
+                        pass
+                progress.start_phase('merge', sum(os.path.getsize(fname) for fname in run_fnames))
+                _merge_runs(run_fnames, output_fs, n_files, _sort_key_function(*key_spec), unique, progress)
+        except:
+            # don't leave half sorted outputs behind, e.g. if a key isn't a number
+            for f in output_fs:
+                f.close()
+            for fname in output_fname:
+                if os.path.exists(fname):
+                    os.remove(fname)
+            raise
+        finally:
+            for f in output_fs:
+                f.close()
+    finally:
+        if run_dir is not None:
+            shutil.rmtree(run_dir, ignore_errors=True)
+    progress.finish()
 
-    for i, output_fname_i in enumerate(output_fname): 
-        with open(output_fname_i, 'w') as output_i:
-            if keep_first_line_first:
-                output_i.write(headers[i])
-            for line in lines:
-                output_i.write(line[i])
 
 def file_generator(fname):
-    """streams a file line by line, and processes that line as a list of integers."""
-    with open(fname, 'r') as f:
-        for line in f:
-            yield [int(v) for v in line.split()]
+    """streams a file line by line, and processes that line as a list of integers.  
+    If the file has a fresh binary cache (see cache_file), the rows are read from that.
+    """
+    for values, offsets in file_batch_generator(fname):
+        values, offsets = values.tolist(), offsets.tolist()
+        for i in xrange(len(offsets) - 1):
+            yield values[offsets[i]:offsets[i + 1]]
+
+
+def file_batch_generator(fname, batch_size = 1024, dtype = int, ragged = True):
+    """streams a file of whitespace separated numbers in batches of batch_size lines 
+    (the last batch may be smaller).  The file is read in large blocks and each block is 
+    parsed by numpy in one go, which is much faster than calling int() on every token.
+
+    If ragged, yields (values, offsets): values is a flat array of all the numbers in the 
+    batch and row i of the batch is values[offsets[i]:offsets[i+1]].  Otherwise yields 
+    2D arrays of shape (n_rows, n_columns), and raises a ValueError if the lines don't 
+    all have the same length.
+
+    Usage:
+    for values, offsets in file_batch_generator("data/features.txt", 256):
+        ...
+    for X in file_batch_generator("data/dense_features.txt", 256, dtype = np.float32, ragged = False):
+        ...
+    """
+    cache = load_file_cache(fname)
+    if cache is not None and cache[0].dtype == np.dtype(dtype):
+        values, offsets = cache
+        for i in xrange(0, len(offsets) - 1, batch_size):
+            batch_offsets = offsets[i:i + batch_size + 1]
+            counts = np.diff(batch_offsets)
+            yield _format_batch((values[batch_offsets[0]:batch_offsets[-1]], counts), ragged)
+        return
+
+    pending = [] # (values, counts) of rows not yet yielded
+    n_pending = 0
+    with open_file(fname, 'rb') as f:
+        carry = ''
+        while True:
+            block = f.read(COPY_BLOCK_SIZE)
+            if not block:
+                if carry:
+                    block = '\n'
+                else:
+                    break
+            block = carry + block
+            end = block.rfind('\n') + 1
+            carry = block[end:]
+            if end:
+                values, counts = _parse_number_lines(block[:end], dtype)
+                pending.append((values, counts))
+                n_pending += len(counts)
+            while n_pending >= batch_size:
+                batch, pending, n_pending = _take_rows(pending, batch_size)
+                yield _format_batch(batch, ragged)
+    if n_pending:
+        batch, pending, n_pending = _take_rows(pending, n_pending)
+        yield _format_batch(batch, ragged)
+
+
+class Progress(object):
+    """Keeps track of how far along a long running file function is (bytes and lines 
+    processed, rate, ETA and the time spent in each phase, e.g. the counting pass and the 
+    writing pass), and passes a status dict to report at most every interval seconds.
+
+    The file functions take a progress argument, which can be:
+        None: no reporting, at no cost (the default).
+        'meter': a single line meter in the terminal, drawn with colorprint.
+        'json': one JSON status per line on stderr.
+        a file object: one JSON status per line, written to it.
+        a function: called with each status dict.
+        a Progress.
+    Lines are counted a block at a time, so the overhead is tiny.
+
+    Usage:
+    split_file('./data/big_log.txt', './data/big_log_split', progress = 'meter')
+    make_dev_train_sets(..., progress = lambda status: my_log.append(status))
+    """
+    def __init__(self, report, name = '', interval = .5):
+        self.name = name
+        self.interval = interval
+        self.phase = None
+        self.phase_times = collections.OrderedDict()
+        self._report = report
+        self._start = time.time()
+        self._n_users = 0 # the file functions currently using this Progress, see _make_progress
+        self.start_phase(None)
+
+    def start_phase(self, phase, total_bytes = None):
+        """ends the current phase, and starts counting the next one."""
+        now = time.time()
+        if self.phase is not None:
+            self.phase_times[self.phase] = self.phase_times.get(self.phase, 0) + now - self._phase_start
+        self.phase = phase
+        self.total_bytes = total_bytes
+        self.bytes = self.lines = 0
+        self._phase_start = self._last_report = now
+
+    def advance(self, n_bytes = 0, n_lines = 0):
+        self.bytes += n_bytes
+        self.lines += n_lines
+        now = time.time()
+        if now - self._last_report >= self.interval:
+            self._last_report = now
+            self._report(self.status(now))
+
+    def iter_lines(self, f):
+        """iterates over the lines of the open file f, advancing once per block of lines.
+        (Chaining the blocks keeps the per line work in C.)
+        """
+        return itertools.chain.from_iterable(self._line_blocks(f))
+
+    def _line_blocks(self, f):
+        for lines in iter(lambda: f.readlines(COPY_BLOCK_SIZE), []):
+            self.advance(sum(map(len, lines)), len(lines))
+            yield lines
+
+    def finish(self):
+        """reports that the work is done, once every function using this has finished."""
+        self._n_users -= 1
+        if self._n_users > 0:
+            return
+        self.start_phase(None)
+        self._report(self.status(done = True))
+
+    def status(self, now = None, done = False):
+        now = now or time.time()
+        elapsed = now - self._phase_start
+        status = {'function': self.name, 'phase': self.phase, 'done': done, 
+                'bytes': self.bytes, 'lines': self.lines, 'elapsed_s': now - self._start, 
+                'bytes_per_s': self.bytes/elapsed if elapsed else 0., 
+                'lines_per_s': self.lines/elapsed if elapsed else 0., 
+                'eta_s': None, 'phase_times': dict(self.phase_times)}
+        if self.total_bytes and self.bytes:
+            status['eta_s'] = (self.total_bytes - self.bytes)/status['bytes_per_s'] if status['bytes_per_s'] else None
+        return status
+
+
+class _NoProgress(object):
+    """stands in for a Progress when none is wanted."""
+    def start_phase(self, phase, total_bytes = None):
+        pass
+
+    def advance(self, n_bytes = 0, n_lines = 0):
+        pass
+
+    def iter_lines(self, f):
+        return f
+
+    def finish(self):
+        pass
+
+_NO_PROGRESS = _NoProgress()
+
+
+CACHE_VALUES_SUFFIX = '.cache_values.npy'
+CACHE_OFFSETS_SUFFIX = '.cache_offsets.npy'
+
+def cache_file(fname, dtype = int):
+    """parses a file of whitespace separated numbers once and saves it next to the file 
+    in binary: a flat array of all the numbers (fname + '.cache_values.npy') and the 
+    offset at which each row starts (fname + '.cache_offsets.npy'; the first two entries 
+    are the size and mtime of fname, so that stale caches are ignored).  After this, 
+    file_generator and file_batch_generator read the rows from the memory-mapped cache 
+    instead of parsing the text.
+
+    Usage:
+    cache_file("data/features.txt")
+    for row in cached_file_generator("data/features.txt"):
+        ...
+    """
+    dtype = np.dtype(dtype)
+    stamp = _file_stamp(fname)
+    fd, raw_fname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fname)))
+    try:
+        n_values = 0
+        offsets = [np.array(stamp + (0,), dtype=np.int64)]
+        with os.fdopen(fd, 'wb') as raw_f:
+            for values, batch_offsets in file_batch_generator(fname, 1 << 16, dtype):
+                raw_f.write(values.tobytes())
+                offsets.append(batch_offsets[1:] + n_values)
+                n_values += len(values)
+        _write_npy_from_raw(raw_fname, fname + CACHE_VALUES_SUFFIX, dtype, n_values)
+    finally:
+        if os.path.exists(raw_fname):
+            os.remove(raw_fname)
+    # the offsets are written last, since a fresh offsets file marks the cache as valid
+    tmp_fname = '%s.%s.tmp'%(fname + CACHE_OFFSETS_SUFFIX, os.getpid())
+    np.save(tmp_fname, np.concatenate(offsets))
+    os.rename(tmp_fname + '.npy', fname + CACHE_OFFSETS_SUFFIX)
+
+
+def load_file_cache(fname):
+    """returns (values, offsets) memory-mapped from the cache written by cache_file, so 
+    that row i of fname is values[offsets[i]:offsets[i+1]], or None if there is no 
+    cache or fname has changed since it was written.
+    """
+    offsets_fname = fname + CACHE_OFFSETS_SUFFIX
+    if not os.path.exists(offsets_fname):
+        return None
+    try:
+        offsets = np.load(offsets_fname, mmap_mode='r')
+        if len(offsets) < 3 or tuple(offsets[:2]) != _file_stamp(fname):
+            return None
+        values = np.load(fname + CACHE_VALUES_SUFFIX, mmap_mode='r')
+    except (IOError, ValueError):
+        return None
+    # plain ndarray views of the maps are much cheaper to slice than np.memmaps
+    return np.asarray(values), np.asarray(offsets[2:])
+
+
+def cached_file_generator(fname, dtype = int):
+    """like file_generator, but yields each row as an array which is a view into the 
+    memory-mapped cache, so no parsing or copying is done.  The cache is made first if 
+    it is missing or stale.
+    """
+    cache = load_file_cache(fname)
+    if cache is None or cache[0].dtype != np.dtype(dtype):
+        cache_file(fname, dtype)
+        cache = load_file_cache(fname)
+    values, offsets = cache
+    for i in xrange(len(offsets) - 1):
+        yield values[offsets[i]:offsets[i + 1]]
+
+
+class LineIndex(object):
+    """Random access to the lines of a (large) file.  The start offset of every line is
+    found once, by scanning the file in large blocks, and saved to a sidecar file 
+    (fname + '.lineidx.npy') which is reused for as long as the size and modification 
+    time of the file don't change.  Lines are then read by seeking, so len() is O(1) 
+    and reading k lines is O(k) rather than O(file).
+
+    Lines are returned the same way iterating over the file returns them, i.e. with 
+    their trailing newline.  Compressed files can't be indexed.
+
+    Usage:
+    with LineIndex("data/clean_mail.tsv") as index:
+        print len(index), index[0], index[-10:]
+
+    """
+    SUFFIX = '.lineidx.npy'
+    HEADER_LEN = 2 # the saved array is [size, mtime_ns, offset_0, ..., offset_n]
+
+    def __init__(self, fname, save = True, progress = None):
+        """
+        @param str fname: the file to index
+        @param bool save: whether to write the index to the sidecar file.  If the 
+              sidecar can't be written (read-only directory, etc), the index is just 
+              kept in memory.
+        @param progress: a Progress which is advanced while the index is built.
+        """
+        if _infer_compression(fname, 'r'):
+            raise ValueError('%s is compressed, so its lines can\'t be indexed'%fname)
+        self.fname = fname
+        self.index_fname = fname + self.SUFFIX
+        self._offsets = self._load()
+        if self._offsets is None:
+            self._offsets = self._build(save, progress or _NO_PROGRESS)
+        self._f = open(fname, 'rb')
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            if step != 1:
+                return [self[j] for j in xrange(start, stop, step)]
+            if start >= stop:
+                return []
+            lines = self.read_range(start, stop).split('\n')
+            return [line + '\n' for line in lines[:-1]] + ([lines[-1]] if lines[-1] else [])
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('line index out of range')
+        return self.read_range(i, i + 1)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._f.close()
+
+    def offset(self, i):
+        """returns the byte offset at which line i starts (len(self) gives the file size)."""
+        return int(self._offsets[i])
+
+    def read_range(self, start, stop):
+        """returns lines start through stop - 1 as a single string."""
+        begin = self.offset(start)
+        self._f.seek(begin)
+        return self._f.read(self.offset(stop) - begin)
+
+    #==================================================================
+    # private functions
+
+    def _load(self):
+        """returns the saved offsets if the sidecar exists and is fresh, else None."""
+        return _saved_line_offsets(self.fname)
+
+    def _build(self, save, progress):
+        size, mtime_ns = _file_stamp(self.fname)
+        newline = ord('\n')
+        starts = [np.zeros(1, dtype=np.int64)]
+        pos = 0
+        with open(self.fname, 'rb') as f:
+            while True:
+                block = f.read(COPY_BLOCK_SIZE)
+                if not block:
+                    break
+                arr = np.frombuffer(block, dtype=np.uint8)
+                starts.append(np.flatnonzero(arr == newline).astype(np.int64) + (pos + 1))
+                pos += len(block)
+                progress.advance(len(block), len(starts[-1]))
+        offsets = np.concatenate(starts)
+        # the last entry is always the file size, so that line i is offsets[i]:offsets[i+1]
+        if offsets[-1] != size:
+            offsets = np.append(offsets, size)
+        if save:
+            tmp_fname = '%s.%s.tmp'%(self.index_fname, os.getpid())
+            try:
+                with open(tmp_fname, 'wb') as f:
+                    np.save(f, np.concatenate([np.array([size, mtime_ns], dtype=np.int64), offsets]))
+                os.rename(tmp_fname, self.index_fname)
+            except (IOError, OSError):
+                pass
+        return offsets
+
+
+class AlignedReader(object):
+    """Reads several files whose lines belong together (e.g. features.txt and 
+    target.txt) in lock-step, a large block of lines at a time, giving rows: tuples of 
+    the i-th line of every file.  All of the multi-file functions in this module read 
+    their inputs with this.
+
+    The files must have the same number of lines; if one runs out before the others, a 
+    ValueError is raised as soon as that is seen (and before reading anything, if the 
+    files all have LineIndex sidecars whose lengths differ).  If strict is False, the 
+    rows just stop at the end of the shortest file, like zip.
+
+    prefetch: if set, every file is read on its own background thread, so reads from 
+        different (slow) disks overlap with each other and with the caller's work.
+        Compressed files are always decompressed on a background thread.
+    progress: a Progress which is advanced as the files are read.
+
+    Rows can be read one at a time with readrow() (e.g. for the headers), iterated over, 
+    or read a block at a time with chunks(), which is fastest.
+
+    Usage:
+    with AlignedReader(["./data/features.txt", "./data/target.txt"]) as reader:
+        headers = reader.readrow()
+        for features, target in reader:
+            ...
+    """
+    def __init__(self, fnames, chunk_size = None, prefetch = False, strict = True, progress = None):
+        """
+        @param fnames: the list of files (or a single file)
+        @param int chunk_size: about how many bytes to read from each file at a time 
+              (default: COPY_BLOCK_SIZE)
+        """
+        if not isinstance(fnames, list):
+            fnames = [fnames]
+        self.fnames = fnames
+        self.chunk_size = chunk_size or COPY_BLOCK_SIZE
+        self.strict = strict
+        self.n_rows = 0 # rows read so far
+        self._progress = progress or _NO_PROGRESS
+        if strict:
+            counts = [_saved_line_count(fname) for fname in fnames]
+            if None not in counts and len(set(counts)) > 1:
+                raise ValueError('the files have different numbers of lines: %s'% \
+                        ', '.join('%s (%s)'%pair for pair in zip(fnames, counts)))
+        self._fs = []
+        try:
+            for fname in fnames:
+                f = open_file(fname, 'r')
+                self._fs.append(_PrefetchReader(f) if prefetch and not isinstance(f, _PrefetchReader) else f)
+        except:
+            self.close()
+            raise
+        self._buffers = [[] for _ in fnames]
+        self._positions = [0]*len(fnames)
+        self._done = False
+
+    def chunks(self, max_rows = None):
+        """yields the remaining rows as lists of row tuples, as many at a time as have been 
+        read from every file (at most max_rows).
+        """
+        while self._fill():
+            n = min(len(buf) - pos for buf, pos in zip(self._buffers, self._positions))
+            if max_rows is not None:
+                n = min(n, max_rows)
+            rows = zip(*[buf[pos:pos + n] for buf, pos in zip(self._buffers, self._positions)])
+            self._positions = [pos + n for pos in self._positions]
+            self.n_rows += n
+            self._progress.advance(0, n)
+            yield rows
+
+    def readrow(self):
+        """returns the next row, or None at the end of the files."""
+        for rows in self.chunks(1):
+            return rows[0]
+        return None
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self.chunks())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        for f in self._fs:
+            f.close()
+
+    #==================================================================
+    # private functions
+
+    def _fill(self):
+        """reads the next block of lines from every file whose buffer is used up.  Returns 
+        whether every buffer has a line left, and checks that the files end together.
+        """
+        if self._done:
+            return False
+        for i, f in enumerate(self._fs):
+            if self._positions[i] == len(self._buffers[i]):
+                self._buffers[i] = f.readlines(self.chunk_size)
+                self._positions[i] = 0
+                self._progress.advance(sum(map(len, self._buffers[i])))
+        ended = [not buf for buf in self._buffers]
+        if any(ended):
+            self._done = True
+            if self.strict and not all(ended):
+                raise ValueError('%s has %s lines, but %s has more'%(self.fnames[ended.index(True)], \
+                        self.n_rows, self.fnames[ended.index(False)]))
+            return False
+        return True
+
+
+class MinibatchLoader(object):
+    """Streams minibatches for SGD from aligned files of whitespace separated numbers 
+    (e.g. features.txt and target.txt), in a new random order every epoch, without writing 
+    a scrambled copy of the data.  Every iteration over the loader is one epoch.
+
+    The rows are shuffled with a shuffle buffer: the first shuffle_buffer rows fill the 
+    buffer, and each row read after that replaces a random row of the buffer, which is 
+    emitted.  The order is only as random as the buffer is big compared to how ordered the 
+    files are; n_shards helps with that: the files are cut into n_shards blocks of lines 
+    (using their LineIndex sidecars, so they can't be compressed) and the blocks are read 
+    in a random order every epoch.
+
+    Each batch of rows is parsed with file_batch_generator's parser into a numpy array per 
+    file: of shape (batch_size, n_columns), or (values, offsets) for files whose dtype is 
+    ragged (see file_batch_generator).  dtype and ragged may be lists, one per file.  A 
+    batch is that array if there is one file, and a tuple of them otherwise.
+
+    The next n_prefetch batches are read and parsed on a background thread, so the training 
+    loop doesn't wait for them.
+
+    seed: if given, every epoch's order is reproducible (but still different from the other 
+        epochs').
+    drop_last: leave out the last batch if it has fewer than batch_size rows.
+
+    Usage:
+    loader = MinibatchLoader(["./data/features.txt", "./data/target.txt"], 256, dtype = [np.float32, int], n_shards = 100)
+    for epoch in range(10):
+        for X, y in loader:
+            ...
+    """
+    def __init__(self, fnames, batch_size = 128, shuffle_buffer = 10000, dtype = int, ragged = False, n_shards = None, \
+            seed = None, n_prefetch = 4, drop_last = False):
+        self._single = not isinstance(fnames, list)
+        self.fnames = [fnames] if self._single else fnames
+        self.batch_size = batch_size
+        self.shuffle_buffer = shuffle_buffer
+        self.dtypes = dtype if isinstance(dtype, list) else [dtype]*len(self.fnames)
+        self.ragged = ragged if isinstance(ragged, list) else [ragged]*len(self.fnames)
+        assert(len(self.dtypes) == len(self.ragged) == len(self.fnames))
+        self.seed = seed
+        self.n_prefetch = n_prefetch
+        self.drop_last = drop_last
+        self.epoch = 0
+        self._shards = self._find_shards(n_shards) if n_shards else None
+
+    def __iter__(self):
+        rng = np.random.RandomState(None if self.seed is None else [self.seed, self.epoch])
+        self.epoch += 1
+        batches = self._batches(rng)
+        return _prefetch_iter(batches, self.n_prefetch) if self.n_prefetch else batches
+
+    #==================================================================
+    # private functions
+
+    def _find_shards(self, n_shards):
+        """cuts the files into n_shards blocks of lines, returning for every block the 
+        (start, end) byte range of it in each file.
+        """
+        shards = []
+        indexes = [LineIndex(fname) for fname in self.fnames]
+        try:
+            lines_in_files = [len(index) for index in indexes]
+            if len(set(lines_in_files)) > 1:
+                raise ValueError('the files have different numbers of lines: %s'% \
+                        ', '.join('%s (%s)'%pair for pair in zip(self.fnames, lines_in_files)))
+            bounds = np.linspace(0, lines_in_files[0], n_shards + 1).astype(int)
+            for start, end in zip(bounds[:-1], bounds[1:]):
+                if end > start:
+                    shards.append([(index.offset(start), index.offset(end)) for index in indexes])
+        finally:
+            for index in indexes:
+                index.close()
+        return shards
+
+    def _row_chunks(self, rng):
+        """yields the rows of the files in blocks, in a random shard order if sharded."""
+        if self._shards is None:
+            with AlignedReader(self.fnames) as reader:
+                for rows in reader.chunks():
+                    yield rows
+            return
+        for k in rng.permutation(len(self._shards)):
+            rows = itertools.izip(*[_iter_range_lines(fname, start, end) for fname, (start, end) in zip(self.fnames, self._shards[k])])
+            for chunk in iter(lambda: list(itertools.islice(rows, 65536)), []):
+                yield chunk
+
+    def _shuffled_chunks(self, rng):
+        """yields the rows passed through the shuffle buffer, in blocks."""
+        buf = []
+        for rows in self._row_chunks(rng):
+            n_fill = min(len(rows), max(0, self.shuffle_buffer - len(buf)))
+            buf.extend(rows[:n_fill])
+            if n_fill == len(rows):
+                continue
+            if not buf:
+                # shuffle_buffer = 0: no shuffling
+                yield rows
+                continue
+            out = []
+            for j, row in itertools.izip(rng.randint(len(buf), size=len(rows) - n_fill), rows[n_fill:]):
+                out.append(buf[j])
+                buf[j] = row
+            yield out
+        rng.shuffle(buf)
+        yield buf
+
+    def _batches(self, rng):
+        pending = []
+        for rows in self._shuffled_chunks(rng):
+            pending.extend(rows)
+            n_full = len(pending) - len(pending)%self.batch_size
+            for i in xrange(0, n_full, self.batch_size):
+                yield self._parse(pending[i:i + self.batch_size])
+            pending = pending[n_full:]
+        if pending and not self.drop_last:
+            yield self._parse(pending)
+
+    def _parse(self, rows):
+        batch = []
+        for lines, dtype, ragged in zip(zip(*rows), self.dtypes, self.ragged):
+            text = ''.join(lines)
+            # (only the last line of a file can be missing its newline, but it may have been shuffled anywhere)
+            if text.count('\n') != len(lines):
+                text = ''.join(line if line.endswith('\n') else line + '\n' for line in lines)
+            batch.append(_format_batch(_parse_number_lines(text, dtype), ragged))
+        return batch[0] if self._single else tuple(batch)
+
+
+class FileCache(object):
+    """A cache of the files made by the file functions (samples, scrambled copies, 
+    dev/train splits), so that rerunning a script with the same inputs and arguments 
+    reuses the files made last time instead of making them again.  Pass it as the cache 
+    argument of make_dev_train_sets, scramble_file_lines or randomly_sample_file.
+
+    Each result is saved under a key made from the function, its arguments and a 
+    fingerprint of every input file: its path, size and modification time or, if 
+    content_hash is set, the md5 of its contents (slower, but survives touching or 
+    copying the input).  On a hit the saved files are hard linked to the output names 
+    (or copied, across filesystems).  Don't edit the outputs in place: a changed entry 
+    is noticed and thrown away, but the edit is lost.
+
+    The least recently used entries are deleted whenever the cache holds more than 
+    disk_budget bytes.
+
+    Usage:
+    cache = FileCache('./data/.cache', disk_budget = 50*2**30)
+    scramble_file_lines("data/huge.tsv", "data/huge_scrambled.tsv", seed = 0, cache = cache)
+    """
+    META_FNAME = 'meta.json'
+
+    def __init__(self, cache_dir = None, disk_budget = 10*2**30, content_hash = False):
+        """
+        @param str cache_dir: where the entries are kept (default: $GENERIC_UTIL_CACHE_DIR,
+              or ~/.cache/generic_util)
+        @param int disk_budget: the most bytes the entries may take up
+        @param bool content_hash: fingerprint the inputs by their contents
+        """
+        if cache_dir is None:
+            cache_dir = os.environ.get('GENERIC_UTIL_CACHE_DIR') or \
+                    os.path.join(os.path.expanduser('~'), '.cache', 'generic_util')
+        self.cache_dir = cache_dir
+        self.disk_budget = disk_budget
+        self.content_hash = content_hash
+        self.hits = self.misses = 0
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def fetch_or_run(self, name, inputs, outputs, params, run):
+        """makes the files outputs, either from the entry for (name, inputs, params) or by
+        calling run() and saving what it writes as that entry.  Returns whether it was a hit.
+        """
+        key = self.key(name, inputs, outputs, params)
+        if self.fetch(key, outputs):
+            self.hits += 1
+            return True
+        self.misses += 1
+        # unlink old outputs, in case they are hard links into the cache
+        for fname in outputs:
+            if os.path.lexists(fname):
+                os.remove(fname)
+        run()
+        self.store(key, outputs, name)
+        return False
+
+    def key(self, name, inputs, outputs, params):
+        """the key of a call to the function name.  The output names don't matter, 
+        except for their compression.
+        """
+        if not isinstance(inputs, list):
+            inputs = [inputs]
+        parts = [name, repr(params), repr([_infer_compression(fname, 'w') for fname in outputs])]
+        parts.extend(repr(self.fingerprint(fname)) for fname in inputs)
+        return hashlib.md5('\n'.join(parts)).hexdigest()
+
+    def fingerprint(self, fname):
+        size, mtime_ns = _file_stamp(fname)
+        if not self.content_hash:
+            return (os.path.abspath(fname), size, mtime_ns)
+        md5 = hashlib.md5()
+        with open(fname, 'rb') as f:
+            for block in iter(lambda: f.read(COPY_BLOCK_SIZE), ''):
+                md5.update(block)
+        return (size, md5.hexdigest())
+
+    def fetch(self, key, outputs):
+        """links the files of entry key to outputs, and returns whether it could."""
+        entry_dir = os.path.join(self.cache_dir, key)
+        meta = self._read_meta(entry_dir)
+        if meta is None:
+            return False
+        entry_fnames = [os.path.join(entry_dir, 'output_%s'%i) for i in range(len(outputs))]
+        if len(meta['stamps']) != len(outputs) or \
+                any(not os.path.exists(fname) or list(_file_stamp(fname)) != stamp for fname, stamp in zip(entry_fnames, meta['stamps'])):
+            # something edited an output (and so the entry) in place
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            return False
+        for entry_fname, fname in zip(entry_fnames, outputs):
+            if os.path.lexists(fname):
+                os.remove(fname)
+            _link_or_copy(entry_fname, fname)
+        # the meta file's mtime is when the entry was last used
+        os.utime(os.path.join(entry_dir, self.META_FNAME), None)
+        return True
+
+    def store(self, key, outputs, name = ''):
+        """saves outputs as entry key, then evicts entries down to the disk budget."""
+        entry_dir = os.path.join(self.cache_dir, key)
+        if os.path.exists(entry_dir):
+            return
+        # build the entry under a temporary name, so a half written entry is never used
+        tmp_dir = tempfile.mkdtemp(prefix='tmp_', dir=self.cache_dir)
+        try:
+            stamps = []
+            for i, fname in enumerate(outputs):
+                entry_fname = os.path.join(tmp_dir, 'output_%s'%i)
+                _link_or_copy(fname, entry_fname)
+                stamps.append(list(_file_stamp(entry_fname)))
+            with open(os.path.join(tmp_dir, self.META_FNAME), 'w') as f:
+                json.dump({'function': name, 'outputs': outputs, 'stamps': stamps}, f)
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # another process stored the same entry first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        self.evict()
+
+    def evict(self, disk_budget = None):
+        """deletes the least recently used entries until the rest fit in disk_budget 
+        bytes (default: self.disk_budget).
+        """
+        if disk_budget is None:
+            disk_budget = self.disk_budget
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, key)
+            meta_fname = os.path.join(entry_dir, self.META_FNAME)
+            # (entries still being stored are named tmp_*)
+            if key.startswith('tmp_') or not os.path.exists(meta_fname):
+                continue
+            size = sum(os.path.getsize(os.path.join(entry_dir, fname)) for fname in os.listdir(entry_dir))
+            entries.append((os.path.getmtime(meta_fname), size, entry_dir))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry_dir in entries:
+            if total <= disk_budget:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
+
+    def clear(self):
+        self.evict(0)
+
+    #==================================================================
+    # private functions
+
+    def _read_meta(self, entry_dir):
+        try:
+            with open(os.path.join(entry_dir, self.META_FNAME)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+
+#-----------------------------------------------------------------------------------------
+# private helpers for the file functions
+
+COPY_BLOCK_SIZE = 1 << 20
+
+def _next_delimited_offset(f, offset, delimitor, block_size = COPY_BLOCK_SIZE):
+    """returns the smallest position >= offset in the (binary) file f which is the start 
+    of a record, i.e. 0, the end of the file, or the position right after a delimitor.
+    """
+    if offset <= 0:
+        return 0
+    # back up so that a delimitor ending exactly at offset is found
+    pos = max(0, offset - len(delimitor))
+    f.seek(pos)
+    carry = ''
+    while True:
+        block = f.read(block_size)
+        if not block:
+            return pos
+        buf = carry + block
+        idx = buf.find(delimitor)
+        while idx != -1 and pos - len(carry) + idx + len(delimitor) < offset:
+            idx = buf.find(delimitor, idx + 1)
+        if idx != -1:
+            return pos - len(carry) + idx + len(delimitor)
+        carry = buf[len(buf) - len(delimitor) + 1:] if len(delimitor) > 1 else ''
+        pos += len(block)
+
+
+def _byte_ranges(fname, n_ranges, delimitor = '\n'):
+    """splits the file into at most n_ranges non-empty (start, end) byte ranges of 
+    roughly equal size, each of which begins and ends on a record boundary.
+    """
+    size = os.path.getsize(fname)
+    with open(fname, 'rb') as f:
+        bounds = [_next_delimited_offset(f, size*i//n_ranges, delimitor) for i in range(n_ranges)]
+    bounds = sorted(set(bounds + [size]))
+    return [(start, end) for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def _copy_byte_range(args):
+    """copies the bytes [start, end) of fname to output_fname in large blocks."""
+    fname, start, end, output_fname = args
+    with open(fname, 'rb') as input_f, open_file(output_fname, 'wb') as output_f:
+        input_f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            block = input_f.read(min(COPY_BLOCK_SIZE, remaining))
+            if not block:
+                break
+            output_f.write(block)
+            remaining -= len(block)
+    return output_fname
+
+
+_COMPRESSION_SUFFIXES = {'gzip': '.gz', 'bz2': '.bz2', 'xz': '.xz'}
+# the first bytes of each kind of file.  A bz2 file starts with BZh, the block size and
+# the magic number of its first block, or of the end of the stream if it is empty
+_COMPRESSION_MAGIC = [(re.compile('\x1f\x8b'), 'gzip'), (re.compile('BZh[1-9](1AY&SY|\x17rE8P\x90)'), 'bz2'), 
+        (re.compile('\xfd7zXZ\x00'), 'xz')]
+
+def _iter_range_lines(fname, start, end):
+    """yields the lines in the byte range [start, end) of fname."""
+    with open(fname, 'rb') as f:
+        f.seek(start)
+        remaining = end - start
+        carry = ''
+        while remaining > 0:
+            block = f.read(min(COPY_BLOCK_SIZE, remaining))
+            if not block:
+                break
+            remaining -= len(block)
+            lines = (carry + block).split('\n')
+            carry = lines.pop()
+            for line in lines:
+                yield line + '\n'
+        if carry:
+            yield carry
+
+
+def _map_reduce_range(args):
+    """the work done on each byte range by parallel_map_file."""
+    fname, start, end, map_fn, reduce_fn, part_fname = args
+    values = itertools.imap(map_fn, _iter_range_lines(fname, start, end))
+    if part_fname is not None:
+        with open(part_fname, 'wb') as part_f:
+            for line in values:
+                if line is not None:
+                    part_f.write(line if line.endswith('\n') else line + '\n')
+        return part_fname
+    if reduce_fn is None:
+        return list(values)
+    # returns (False, None) for an empty range, which has nothing to reduce
+    first = next(values, _EXHAUSTED)
+    if first is _EXHAUSTED:
+        return False, None
+    return True, reduce(reduce_fn, values, first)
+
+
+def _infer_compression(fname, mode = 'r'):
+    """returns the compression of fname ('gzip', 'bz2', 'xz' or None): from its first 
+    bytes if it is being read, or else from its extension.
+    """
+    if 'r' in mode and os.path.isfile(fname):
+        with open(fname, 'rb') as f:
+            magic = f.read(10)
+        for prefix, compression in _COMPRESSION_MAGIC:
+            if prefix.match(magic):
+                return compression
+        return None
+    for compression, suffix in _COMPRESSION_SUFFIXES.items():
+        if fname.endswith(suffix):
+            return compression
+    return None
+
+
+class _PrefetchReader(object):
+    """wraps a (decompressing) file object, reading it in large blocks on a background
+    thread so that decompression overlaps with the caller's work.  Supports iteration 
+    over lines, read, readline and readlines.
+    """
+    def __init__(self, f, n_blocks_ahead = 4):
+        self._f = f
+        self._queue = Queue.Queue(n_blocks_ahead)
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+        self._closed = False
+        self._thread = threading.Thread(target=self._produce)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _produce(self):
+        try:
+            while not self._closed:
+                block = self._f.read(COPY_BLOCK_SIZE)
+                self._put(block)
+                if not block:
+                    return
+        except Exception as e:
+            self._put(e)
+
+    def _put(self, item):
+        while not self._closed:
+            try:
+                self._queue.put(item, timeout=.1)
+                return
+            except Queue.Full:
+                pass
+
+    def _fill(self):
+        """appends the next block to the buffer, returning False at the end of the file."""
+        if self._eof:
+            return False
+        block = self._queue.get()
+        if isinstance(block, Exception):
+            raise block
+        if not block:
+            self._eof = True
+            return False
+        self._buf = self._buf[self._pos:] + block
+        self._pos = 0
+        return True
+
+    def read(self, size = -1):
+        while (size < 0 or len(self._buf) - self._pos < size) and self._fill():
+            pass
+        end = len(self._buf) if size < 0 else self._pos + size
+        data = self._buf[self._pos:end]
+        self._pos += len(data)
+        return data
+
+    def readline(self):
+        idx = self._buf.find('\n', self._pos)
+        while idx == -1:
+            searched = len(self._buf) - self._pos
+            if not self._fill():
+                return self.read()
+            idx = self._buf.find('\n', self._pos + searched)
+        line = self._buf[self._pos:idx + 1]
+        self._pos = idx + 1
+        return line
+
+    def readlines(self, sizehint = None):
+        """returns whole lines adding up to about sizehint bytes, or all of the lines."""
+        if not sizehint:
+            return list(self)
+        while True:
+            end = self._buf.rfind('\n', self._pos) + 1
+            if (end and end - self._pos >= sizehint) or not self._fill():
+                break
+        if self._eof:
+            end = len(self._buf)
+        lines = self._buf[self._pos:end].split('\n')
+        self._pos = end
+        last = lines.pop()
+        return [line + '\n' for line in lines] + ([last] if last else [])
+
+    def __iter__(self):
+        while True:
+            lines = self._buf[self._pos:].split('\n')
+            self._buf, self._pos = lines.pop(), 0
+            for line in lines:
+                yield line + '\n'
+            if not self._fill():
+                break
+        if self._buf:
+            yield self.read()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self._closed = True
+        self._thread.join()
+        self._f.close()
+
+
+def _saved_line_offsets(fname):
+    """returns the line offsets in the LineIndex sidecar of fname if it exists and is 
+    fresh, else None.
+    """
+    index_fname = fname + LineIndex.SUFFIX
+    if not os.path.exists(index_fname):
+        return None
+    try:
+        saved = np.load(index_fname, mmap_mode='r')
+    except (IOError, ValueError):
+        return None
+    if len(saved) <= LineIndex.HEADER_LEN or tuple(saved[:LineIndex.HEADER_LEN]) != _file_stamp(fname):
+        return None
+    return saved[LineIndex.HEADER_LEN:]
+
+
+def _saved_line_count(fname):
+    """the number of lines of fname according to its LineIndex sidecar, or None if it 
+    doesn't have a fresh one.
+    """
+    offsets = _saved_line_offsets(fname)
+    return None if offsets is None else len(offsets) - 1
+
+
+def _get_file_cache(cache):
+    """the FileCache to use for the cache argument of the file functions: None, a 
+    FileCache, or True for the default one.
+    """
+    if cache is True:
+        return FileCache()
+    return cache or None
+
+
+def _link_or_copy(src, dst):
+    """hard links dst to src, or copies src to dst if they are on different filesystems."""
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+def _prefetch_iter(iterable, n_ahead):
+    """iterates over iterable on a background thread, keeping up to n_ahead items 
+    ready, so that producing the items overlaps with the caller's work.
+    """
+    queue = Queue.Queue(n_ahead)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((True, item)):
+                    return
+            put((False, None))
+        except Exception as e:
+            put((False, e))
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            more, item = queue.get()
+            if not more:
+                if item is not None:
+                    raise item
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+def _count_lines(fname, progress = None):
+    """the number of lines in fname, from its LineIndex or, for compressed files, by 
+    streaming through it.
+    """
+    progress = progress or _NO_PROGRESS
+    progress.start_phase('count', os.path.getsize(fname))
+    if not _infer_compression(fname, 'r'):
+        with LineIndex(fname, progress = progress) as index:
+            return len(index)
+    n_lines = 0
+    last = '\n'
+    with open_file(fname, 'rb') as f:
+        for block in iter(lambda: f.read(COPY_BLOCK_SIZE), ''):
+            n_lines += block.count('\n')
+            last = block[-1]
+            progress.advance(len(block), block.count('\n'))
+    return n_lines + (last != '\n')
+
+
+def _make_progress(progress, name):
+    """turns the progress argument of a file function into a Progress (or _NO_PROGRESS)."""
+    if progress is None or progress is _NO_PROGRESS:
+        return _NO_PROGRESS
+    if isinstance(progress, Progress):
+        progress._n_users += 1
+        return progress
+    elif progress == 'meter':
+        report = _report_meter
+    elif progress == 'json':
+        report = lambda status: _report_json(status, sys.stderr)
+    elif hasattr(progress, 'write'):
+        out_f = progress
+        report = lambda status: _report_json(status, out_f)
+    elif callable(progress):
+        report = progress
+    else:
+        raise ValueError('unknown progress %s'%progress)
+    new_progress = Progress(report, name)
+    new_progress._n_users += 1
+    return new_progress
+
+
+def _report_meter(status):
+    if status['done']:
+        message = '%s done in %.1fs (%s)'%(status['function'], status['elapsed_s'], 
+                ', '.join('%s %.1fs'%pair for pair in status['phase_times'].items()))
+        colorprint('\r' + message + ' '*20, 'green?')
+        return
+    message = '%s [%s] %s, %.1f MB/s, %s lines'%(status['function'], status['phase'], 
+            _format_bytes(status['bytes']), status['bytes_per_s']/2**20, status['lines'])
+    if status['eta_s'] is not None:
+        message += ', ETA %ds'%status['eta_s']
+    colorprint('\r' + message + ' '*10, 'teal', end = '')
+
+
+def _report_json(status, f):
+    f.write(json.dumps(status) + '\n')
+    f.flush()
+
+
+def _format_bytes(n_bytes):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if n_bytes < 1024:
+            return '%.1f %s'%(n_bytes, unit)
+        n_bytes /= 1024.
+    return '%.1f TB'%n_bytes
+
+
+def _file_stamp(fname):
+    """returns (size, mtime in ns) of fname, used to tell whether a sidecar file is stale."""
+    st = os.stat(fname)
+    return st.st_size, int(round(st.st_mtime*1e9))
+
+
+def _write_npy_from_raw(raw_fname, npy_fname, dtype, n_values):
+    """turns a file of raw binary values into a 1D .npy file, without loading it."""
+    tmp_fname = '%s.%s.tmp'%(npy_fname, os.getpid())
+    with open(tmp_fname, 'wb') as output_f, open(raw_fname, 'rb') as input_f:
+        np.lib.format.write_array_header_1_0(output_f, 
+                {'descr': np.lib.format.dtype_to_descr(dtype), 'fortran_order': False, 'shape': (n_values,)})
+        shutil.copyfileobj(input_f, output_f, COPY_BLOCK_SIZE)
+    os.rename(tmp_fname, npy_fname)
+
+
+def _parse_number_lines(text, dtype):
+    """parses text, which is made of whole lines of whitespace separated numbers, 
+    returning the flat array of numbers and the number of numbers on each line.
+    """
+    chars = np.frombuffer(text, dtype=np.uint8)
+    is_newline = chars == ord('\n')
+    # ' ', and '\t' through '\r'
+    is_space = (chars == 32) | ((chars >= 9) & (chars <= 13))
+    # a token starts at every non-space character that follows a space (or the start)
+    token_starts = ~is_space
+    token_starts[1:] &= is_space[:-1]
+    line_of_token = np.cumsum(is_newline)[token_starts]
+    counts = np.bincount(line_of_token, minlength=int(is_newline.sum()))
+    if not np.issubdtype(dtype, np.integer):
+        # numpy's float parsing turns every token into a float or raises, unlike 
+        # np.fromstring, which silently stops at the first bad token
+        return np.array(text.split()).astype(dtype), counts
+
+    # np.fromstring is only trusted with tokens that are all [-+]?[0-9]+; anything else
+    # goes through int() like before, which raises on bad tokens
+    is_digit = (chars >= 48) & (chars <= 57)
+    is_sign = (chars == 43) | (chars == 45)
+    well_formed = not (~(is_digit | is_sign | is_space)).any() \
+            and not (is_sign & ~token_starts).any() \
+            and not (len(chars) and is_sign[-1]) and not (is_sign[:-1] & ~is_digit[1:]).any()
+    if well_formed:
+        values = np.fromstring(text, dtype=np.int64, sep=' ')
+        info = np.iinfo(dtype)
+        # fromstring saturates on overflow, so values at the int64 limits may be wrong
+        in_range = not len(values) or (values.min() > max(info.min, -2**63) and values.max() < min(info.max, 2**63 - 1))
+        if len(values) == counts.sum() and in_range:
+            return values.astype(dtype), counts
+    values = [int(token) for token in text.split()]
+    info = np.iinfo(dtype)
+    if values and (min(values) < info.min or max(values) > info.max):
+        # keep the exact python longs
+        return np.array(values, dtype=object), counts
+    return np.array(values, dtype=dtype), counts
+
+
+def _take_rows(pending, n_rows):
+    """removes the first n_rows rows from the list of (values, counts) pieces pending, 
+    returning them as a single (values, counts) and the rest of pending.
+    """
+    taken_values, taken_counts, rest = [], [], []
+    need = n_rows
+    for values, counts in pending:
+        if need == 0:
+            rest.append((values, counts))
+        elif len(counts) <= need:
+            taken_values.append(values)
+            taken_counts.append(counts)
+            need -= len(counts)
+        else:
+            n_values = counts[:need].sum()
+            taken_values.append(values[:n_values])
+            taken_counts.append(counts[:need])
+            rest.append((values[n_values:], counts[need:]))
+            need = 0
+    n_rest = sum(len(counts) for values, counts in rest)
+    return (np.concatenate(taken_values), np.concatenate(taken_counts)), rest, n_rest
+
+
+def _format_batch(batch, ragged):
+    values, counts = batch
+    if ragged:
+        offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+        return values, offsets
+    if len(counts) and (counts != counts[0]).any():
+        raise ValueError('lines have different lengths; use ragged = True')
+    return values.reshape(len(counts), counts[0] if len(counts) else 0)
+
+
+def _add_header_job(args):
+    fname, header = args
+    fd, tmp_fname = tempfile.mkstemp(prefix='.' + os.path.basename(fname) + '.', \
+            dir=os.path.dirname(os.path.abspath(fname)))
+    compression = _infer_compression(fname, 'r')
+    try:
+        os.close(fd)
+        # compressed files have to be decompressed and compressed again
+        with open_file(tmp_fname, 'wb', compression) as output_f, open_file(fname, 'rb', compression) as input_f:
+            output_f.write(header)
+            shutil.copyfileobj(input_f, output_f, COPY_BLOCK_SIZE)
+        shutil.copymode(fname, tmp_fname)
+        os.rename(tmp_fname, fname)
+    except:
+        os.remove(tmp_fname)
+        raise
+    return fname
+
+
+# the most runs sort_file merges at once; more are merged in several passes
+MERGE_FAN_IN = 128
+
+def _sort_key_function(key, column_delimitor, numeric):
+    """the sort key of a line, for sort_file."""
+    key_fn = _line_key_function(key, column_delimitor)
+    if numeric:
+        return lambda line: float(key_fn(line) or 0)
+    return key_fn
+
+
+def _sort_rows(rows, key_spec, unique):
+    """stably sorts rows (tuples of lines) by the key of their first line, dropping 
+    all but the first row with each key if unique.
+    """
+    keys = map(_sort_key_function(*key_spec), [row[0] for row in rows])
+    order = sorted(xrange(len(rows)), key=keys.__getitem__)
+    if unique:
+        order = [i for j, i in enumerate(order) if j == 0 or keys[i] != keys[order[j - 1]]]
+    return [rows[i] for i in order]
+
+
+def _write_rows(rows, output_fs = None, run_fname = None):
+    """writes rows either line i to output_fs[i], or all of the lines of each row 
+    consecutively to the run file run_fname.  Lines are given a newline if they lack one.
+    """
+    if run_fname is not None:
+        with open(run_fname, 'w') as f:
+            _write_rows(rows, [f])
+        return
+    if len(output_fs) == 1:
+        columns = [[line for row in rows for line in row]]
+    else:
+        columns = [[row[i] for row in rows] for i in range(len(output_fs))]
+    for output_i, lines in zip(output_fs, columns):
+        _write_lines(output_i, lines)
+
+
+def _write_lines(f, lines, block_size = 65536):
+    """writes lines to f, block_size lines at a time, giving any line without a newline 
+    one.  (Only the last line of a file can be missing its newline, but after sorting or 
+    shuffling it may be anywhere.)
+    """
+    for start in xrange(0, len(lines), block_size):
+        block = lines[start:start + block_size]
+        text = ''.join(block)
+        if text.count('\n') != len(block):
+            text = ''.join(line if line.endswith('\n') else line + '\n' for line in block)
+        f.write(text)
+
+
+def _sort_run(args):
+    """sorts a run file of sort_file in place.  Run in the worker processes."""
+    run_fname, n_files, key_spec, unique = args
+    with open(run_fname) as f:
+        rows = zip(*[iter(f.readlines())]*n_files)
+    _write_rows(_sort_rows(rows, key_spec, unique), run_fname = run_fname)
+
+
+def _keyed_run_rows(run_fname, run_i, n_files, key_fn):
+    """yields (key, run_i, j, row) for the rows of a sorted run file, which heapq.merge 
+    then orders stably by key.
+    """
+    with open(run_fname) as f:
+        for j, row in enumerate(itertools.izip(*[f]*n_files)):
+            yield key_fn(row[0]), run_i, j, row
+
+
+def _merge_runs(run_fnames, output_fs, n_files, key_fn, unique, progress):
+    """merges the sorted run files of sort_file into output_fs, first merging them 
+    MERGE_FAN_IN at a time into bigger runs if there are too many to open at once.
+    """
+    while len(run_fnames) > MERGE_FAN_IN:
+        merged_fnames = []
+        for start in range(0, len(run_fnames), MERGE_FAN_IN):
+            group = run_fnames[start:start + MERGE_FAN_IN]
+            merged_fnames.append(group[0] + '_merged')
+            with open(merged_fnames[-1], 'w') as f:
+                _merge_runs(group, [f], n_files, key_fn, unique, _NO_PROGRESS)
+            for fname in group:
+                os.remove(fname)
+        run_fnames = merged_fnames
+
+    merged = heapq.merge(*[_keyed_run_rows(fname, i, n_files, key_fn) for i, fname in enumerate(run_fnames)])
+    last_key = _EXHAUSTED
+    for batch in iter(lambda: list(itertools.islice(merged, 65536)), []):
+        if unique:
+            rows = []
+            for k, _, _, row in batch:
+                if k != last_key:
+                    rows.append(row)
+                    last_key = k
+        else:
+            rows = [row for _, _, _, row in batch]
+        _write_rows(rows, output_fs)
+        progress.advance(sum(len(line) for row in rows for line in row), len(rows))
+
+
+def _sample_indices(low, high, k, rng = None):
+    """returns k distinct integers drawn uniformly from [low, high) in random order, using 
+    memory proportional to k when k is small relative to the range.
+    """
+    rng = rng or np.random
+    n = high - low
+    k = min(k, n)
+    if 2*k >= n:
+        return list(rng.permutation(n)[:k] + low)
+    chosen = set()
+    order = []
+    while len(order) < k:
+        for i in rng.randint(low, high, size=k - len(order)):
+            if i not in chosen:
+                chosen.add(i)
+                order.append(int(i))
+    return order
+
+
+def _stable_unit_hash(s, salt = ''):
+    """maps salt + s to a float in [0, 1) which, unlike hash(), is the same on every run 
+    and every machine.  s may also be a number etc (e.g. a key function's result), which 
+    is hashed as str(s).
+    """
+    if not isinstance(s, basestring):
+        s = str(s)
+    s = salt + s
+    if isinstance(s, unicode):
+        s = s.encode('utf-8')
+    return struct.unpack('>Q', hashlib.md5(s).digest()[:8])[0]/float(1 << 64)
+
+
+def _line_key_function(key, column_delimitor):
+    """returns the function giving the key of a line that the hash based functions hash: 
+    the whole line if key is None, column key (split on column_delimitor) if key is an 
+    int, or key itself if it is a function.  Lines without column key (e.g. blank 
+    lines) have the key '', as in GNU sort.
+    """
+    if key is None:
+        return lambda line: line.rstrip('\n')
+    if callable(key):
+        return key
+    def column_key(line):
+        columns = line.rstrip('\n').split(column_delimitor)
+        return columns[key] if -len(columns) <= key < len(columns) else ''
+    return column_key
+
+
+class _ShardWriter(object):
+    """writes lines to many files (e.g. thousands of shards) without keeping them all 
+    open: the lines are buffered per file, and when the buffers together pass buffer_size 
+    bytes, each buffer is appended to its file and the file is closed again.  The files 
+    are truncated first.
+    """
+    def __init__(self, fnames, buffer_size = 64 << 20, compression = None):
+        self.fnames = fnames
+        self.buffer_size = buffer_size
+        self.compression = compression
+        self._buffers = [[] for _ in fnames]
+        self._n_buffered = 0
+        for fname in fnames:
+            open_file(fname, 'w', compression).close()
+
+    def write(self, i, line):
+        self._buffers[i].append(line)
+        self._n_buffered += len(line)
+        if self._n_buffered >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        for fname, buf in zip(self.fnames, self._buffers):
+            if buf:
+                with open_file(fname, 'a', self.compression) as f:
+                    f.write(''.join(buf))
+                del buf[:]
+        self._n_buffered = 0
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+_EXHAUSTED = object()
+
+def _reservoir_sample(iterable, k, rng = None):
+    """uniformly samples k items from an iterable of unknown length in one pass, with
+    Li's Algorithm L: after the reservoir fills up, the number of items to skip before
+    the next replacement is drawn directly, so skipped items are never stored.
+    Returns a list of (position, item), sorted by position.
+    """
+    if k <= 0:
+        return []
+    rng = rng or np.random
+    it = iter(iterable)
+    reservoir = list(itertools.islice(enumerate(it), k))
+    if len(reservoir) < k:
+        return reservoir
+
+    def unit():
+        u = 0.
+        while u == 0.:
+            u = rng.random_sample()
+        return u
+
+    w = np.exp(np.log(unit())/k)
+    i = k - 1
+    while True:
+        skip = int(np.floor(np.log(unit())/np.log1p(-w)))
+        item = next(itertools.islice(it, skip, None), _EXHAUSTED)
+        if item is _EXHAUSTED:
+            break
+        i += skip + 1
+        reservoir[rng.randint(k)] = (i, item)
+        w *= np.exp(np.log(unit())/k)
+    reservoir.sort(key=lambda pair: pair[0])
+    return reservoir
+
+
+def _map_jobs(fn, jobs, n_workers = None, initializer = None, initargs = ()):
+    """applies fn to every element of jobs, in a pool of n_workers processes if there 
+    is more than one job and worker.  fn must be a module level function.  
+    initializer(*initargs) is called first, once per process.
+    """
+    return list(_imap_jobs(fn, jobs, n_workers, initializer, initargs))
+
+
+def _imap_jobs(fn, jobs, n_workers = None, initializer = None, initargs = ()):
+    """like _map_jobs, but yields the results in order as they become available."""
+    if n_workers is None:
+        n_workers = multiprocessing.cpu_count()
+    n_workers = min(n_workers, len(jobs))
+    if n_workers <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for job in jobs:
+            yield fn(job)
+        return
+    pool = multiprocessing.Pool(n_workers, initializer, initargs)
+    try:
+        for result in pool.imap(fn, jobs):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
 
 
 #-----------------------------------------------------------------------------------------            
 
-def colorprint(message, color="rand"):
+def colorprint(message, color="rand", end='\n'):
     message = unicode(message)
     """prints your message in pretty colors! So far, only a few color are available."""
     if color == 'none': print message
     if color == 'demo':
         for i in range(99):
             print '\n%i-'%i + '\033[%sm'%i + message + '\033[0m\t',
-    print '\033[%sm'%{
+    sys.stdout.write('\033[%sm'%{
         'neutral' : 99,
         'flashing' : 5,
         'underline' : 4,
@@ -269,7 +2293,153 @@ def colorprint(message, color="rand"):
         'green?' : 92,
         'red' : 91,
         'bold' : 1
-    }.get(color, 1)  + message + '\033[0m'
+    }.get(color, 1)  + message + '\033[0m' + end)
+    sys.stdout.flush()
+
+
+# perf_counter_ns where python has it (3.7+), else the best clock python 2 has
+_now_ns = getattr(time, 'perf_counter_ns', None) or (lambda: int(time.time()*1e9))
+
+class TimingRegistry(object):
+    """Records how long named sections of code take: the number of calls, and the total,
+    mean and 95th percentile time.  Sections entered inside other sections are recorded 
+    under 'outer/inner'.  If enabled is False, sections and timed functions just run, 
+    at (nearly) no cost.
+
+    TIMINGS is the registry used by the module level timer and timed.
+
+    Usage:
+    @timed()
+    def load(fname):
+        ...
+
+    for batch in batches:
+        with timer('sgd step'):
+            ...
+    TIMINGS.report()
+    """
+    MAX_SAMPLES = 10000 # per section, for the percentiles
+
+    def __init__(self, enabled = True):
+        self.enabled = enabled
+        # its own random stream, so that timing doesn't change the results of seeded scripts
+        self._random = random.Random()
+        self.reset()
+
+    def reset(self):
+        self._counts = defaultdict(int)
+        self._totals = defaultdict(int)
+        self._samples = defaultdict(list)
+        self._local = threading.local()
+
+    def section(self, name):
+        """a context manager which times its body as name."""
+        if not self.enabled:
+            return _NULL_SECTION
+        return _Section(self, name)
+
+    def timed(self, name = None):
+        """a decorator which times every call of the function, as name (by default, the 
+        function's name).
+        """
+        def decorator(fn):
+            section_name = name or fn.__name__
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+                with _Section(self, section_name):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def record(self, name, duration_ns):
+        self._counts[name] += 1
+        self._totals[name] += duration_ns
+        samples = self._samples[name]
+        # reservoir sampling keeps the samples a uniform sample of all of the calls
+        if len(samples) < self.MAX_SAMPLES:
+            samples.append(duration_ns)
+        else:
+            i = self._random.randint(0, self._counts[name] - 1)
+            if i < self.MAX_SAMPLES:
+                samples[i] = duration_ns
+
+    def stats(self):
+        """returns a dict from each section name to its calls and total, mean and p95 
+        seconds.
+        """
+        stats = {}
+        for name, count in self._counts.iteritems():
+            samples = sorted(self._samples[name])
+            stats[name] = {'calls': count, 
+                    'total_s': self._totals[name]/1e9, 
+                    'mean_s': self._totals[name]/1e9/count, 
+                    'p95_s': samples[min(len(samples) - 1, int(.95*len(samples)))]/1e9}
+        return stats
+
+    def report(self, color = 'teal'):
+        """prints a table of the sections with colorprint, slowest (in total) first."""
+        stats = self.stats()
+        colorprint('%-40s %10s %12s %12s %12s'%('section', 'calls', 'total (s)', 'mean (s)', 'p95 (s)'), color)
+        for name in sorted(stats, key=lambda name: -stats[name]['total_s']):
+            s = stats[name]
+            colorprint('%-40s %10d %12.4f %12.6f %12.6f'%(name, s['calls'], s['total_s'], s['mean_s'], s['p95_s']), color)
+
+    def to_json(self, fname = None):
+        """returns the stats as JSON, also writing them to fname if it is given."""
+        dump = json.dumps(self.stats(), indent = 2, sort_keys = True)
+        if fname is not None:
+            with open(fname, 'w') as f:
+                f.write(dump)
+        return dump
+
+    def _stack(self):
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        return self._local.stack
+
+
+class _Section(object):
+    __slots__ = ['_registry', '_name', '_path', '_start']
+
+    def __init__(self, registry, name):
+        self._registry = registry
+        self._name = name
+
+    def __enter__(self):
+        # the name nested under the enclosing sections, worked out on every entry, so 
+        # that the section can be reused in different places
+        stack = self._registry._stack()
+        self._path = stack[-1] + '/' + self._name if stack else self._name
+        stack.append(self._path)
+        self._start = _now_ns()
+        return self
+
+    def __exit__(self, *args):
+        duration = _now_ns() - self._start
+        self._registry._stack().pop()
+        self._registry.record(self._path, duration)
+
+
+class _NullSection(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+_NULL_SECTION = _NullSection()
+
+TIMINGS = TimingRegistry()
+
+def timer(name):
+    """times its body as the section name in TIMINGS (see TimingRegistry)."""
+    return TIMINGS.section(name)
+
+def timed(name = None):
+    """times every call of the decorated function in TIMINGS (see TimingRegistry)."""
+    return TIMINGS.timed(name)
 
 
 def time_string(precision='day'):
@@ -296,15 +2466,336 @@ def random_string_signature(length = 4):
     np.random.shuffle(candidates)
     return "".join(candidates[0:length])
 
+
+def check_import_time(max_seconds = .05, n_tries = 3):
+    """imports generic_util in fresh python processes, and raises an AssertionError if 
+    that takes longer than max_seconds (in the fastest of n_tries tries), or if it 
+    imports any of the heavy modules which should only be imported when first used.  
+    Run this after adding imports to this file.
+    """
+    import subprocess
+    code = "import sys, time; t = time.time(); import generic_util; " \
+            "print time.time() - t; print ' '.join(sys.modules)"
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    times = []
+    for _ in range(n_tries):
+        output = subprocess.check_output([sys.executable, '-c', code], cwd=cwd).split('\n')
+        times.append(float(output[0]))
+    imported = set(name.split('.')[0] for name in output[1].split())
+    eager = sorted(imported & set(_LAZY_MODULES))
+    assert not eager, 'importing generic_util imports %s'%', '.join(eager)
+    assert min(times) <= max_seconds, 'importing generic_util took %.3fs'%min(times)
+    return min(times)
+
+# str_parse splits on whitespace, slashes and commas, and drops the punctuation below.  
+# (Commas are separators, so they must not be deleted before splitting.)
+_STR_PARSE_TOKEN = re.compile(r'[^\s/\\,]+')
+_STR_PARSE_PUNCTUATION = '<>.;:!?"'
+_STR_PARSE_UNICODE_TABLE = dict((ord(c), None) for c in _STR_PARSE_PUNCTUATION)
+
 def str_parse(s, to_lower = True):
-    parse = re.split('[\s/\\\\,]', s)
-    # below line fails on unicode
-    # parse = [w.translate(string.maketrans("",""), string.punctuation) for w in parse]
-    parse = [re.sub('[,<>\.;:!?\"]', '', w) for w in parse]
-    parse = [w for w in parse if w]
+    # the punctuation is deleted with translate, which works on both str and unicode
+    if isinstance(s, unicode):
+        s = s.translate(_STR_PARSE_UNICODE_TABLE)
+    else:
+        s = s.translate(None, _STR_PARSE_PUNCTUATION)
     if to_lower:
-        parse = [w.lower() for w in parse]
-    return parse
+        s = s.lower()
+    return _STR_PARSE_TOKEN.findall(s)
+
+
+def str_parse_many(strings, to_lower = True, n_workers = 1, chunk_size = 10000):
+    """yields str_parse(s) for every s in strings, in order.  With n_workers > 1 the 
+    strings are parsed in chunks of chunk_size by a pool of processes.
+
+    Usage:
+    for tokens in str_parse_many(open("data/mip_personal.tsv")):
+        ...
+    """
+    strings = iter(strings)
+    chunks = iter(lambda: list(itertools.islice(strings, chunk_size)), [])
+    jobs = ((chunk, to_lower) for chunk in chunks)
+    if n_workers is None:
+        n_workers = multiprocessing.cpu_count()
+    if n_workers <= 1:
+        for chunk in chunks:
+            for s in chunk:
+                yield str_parse(s, to_lower)
+        return
+    pool = multiprocessing.Pool(n_workers)
+    try:
+        for parsed in pool.imap(_str_parse_chunk, jobs):
+            for tokens in parsed:
+                yield tokens
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def str_parse_file(fname, to_lower = True, n_workers = 1, chunk_size = 10000):
+    """yields str_parse(line) for every line of the file fname, in order (see str_parse_many)."""
+    with open_file(fname, 'r') as f:
+        for tokens in str_parse_many(f, to_lower, n_workers, chunk_size):
+            yield tokens
+
+
+def _str_parse_chunk(args):
+    chunk, to_lower = args
+    return [str_parse(s, to_lower) for s in chunk]
+
+
+def build_vocabulary(fnames, min_count = 1, max_size = None, to_lower = True, n_workers = None):
+    """counts the str_parse tokens of every line of the file(s) fnames, and returns the 
+    vocabulary as a list of (token, count), most frequent first, keeping only tokens seen 
+    at least min_count times and at most max_size tokens.  The files are counted in 
+    byte ranges by a pool of n_workers processes whose partial counts are then merged, so 
+    memory depends on the size of the vocabulary, not of the corpus.
+
+    Usage:
+    vocab = build_vocabulary(["data/mail_1.tsv", "data/mail_2.tsv"], min_count = 5)
+    encode_file("data/mail_1.tsv", "data/mail_1_ids.txt", vocab)
+    for ids in file_generator("data/mail_1_ids.txt"):
+        ...
+    """
+    if not isinstance(fnames, list):
+        fnames = [fnames]
+    if n_workers is None:
+        n_workers = multiprocessing.cpu_count()
+    jobs = []
+    for fname in fnames:
+        if _infer_compression(fname, 'r'):
+            # can't be split into byte ranges, so is counted in one piece
+            jobs.append((fname, None, None, to_lower))
+        else:
+            jobs.extend((fname, start, end, to_lower) for start, end in _byte_ranges(fname, 4*n_workers))
+    counts = Counter()
+    for partial_counts in _map_jobs(_count_tokens_range, jobs, n_workers):
+        counts.update(partial_counts)
+    vocab = [(token, count) for token, count in counts.most_common(max_size) if count >= min_count]
+    return vocab
+
+
+def encode_file(fname, output_fname, vocab, to_lower = True, unknown_id = None, binary = False, n_workers = None):
+    """writes the str_parse tokens of every line of fname as the ids of the tokens in 
+    vocab, as whitespace separated integers (the format file_generator reads).  Tokens 
+    which aren't in vocab are dropped, or written as unknown_id if it is given.
+
+    vocab is a list of (token, count), as returned by build_vocabulary (the id of a token 
+    is its position in the list), or a dict from tokens to ids.
+
+    If binary, output_fname is instead written as a .npy array of all the ids, and 
+    output_fname + '.offsets.npy' holds the offset of the start of every row (so that row i
+    is ids[offsets[i]:offsets[i+1]]).
+    """
+    ids = vocab if isinstance(vocab, dict) else dict((token, i) for i, (token, count) in enumerate(vocab))
+    if not binary and not _infer_compression(fname, 'r'):
+        parallel_map_file(fname, _encode_line, n_workers = n_workers, output_fname = output_fname, \
+                initializer = _init_encoder, initargs = (ids, to_lower, unknown_id))
+        return
+
+    _init_encoder(ids, to_lower, unknown_id)
+    if not binary:
+        with open_file(fname, 'r') as input_f, open_file(output_fname, 'w') as output_f:
+            for line in input_f:
+                output_f.write(_encode_line(line))
+        return
+
+    dtype = np.dtype(np.int32 if max(ids.values() + [unknown_id or 0]) < 2**31 else np.int64)
+    fd, raw_fname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(output_fname)))
+    try:
+        offsets = [0]
+        with os.fdopen(fd, 'wb') as raw_f, open_file(fname, 'r') as input_f:
+            for line in input_f:
+                row = _encode_tokens(line)
+                raw_f.write(np.array(row, dtype=dtype).tobytes())
+                offsets.append(offsets[-1] + len(row))
+        _write_npy_from_raw(raw_fname, output_fname, dtype, offsets[-1])
+    finally:
+        if os.path.exists(raw_fname):
+            os.remove(raw_fname)
+    np.save(output_fname + '.offsets.npy', np.array(offsets, dtype=np.int64))
+
+
+def _count_tokens_range(args):
+    fname, start, end, to_lower = args
+    counts = Counter()
+    if start is None:
+        with open_file(fname, 'r') as f:
+            for line in f:
+                counts.update(str_parse(line, to_lower))
+    else:
+        for line in _iter_range_lines(fname, start, end):
+            counts.update(str_parse(line, to_lower))
+    return counts
+
+
+# the state of encode_file in each worker process
+_ENCODER = {}
+
+def _init_encoder(ids, to_lower, unknown_id):
+    _ENCODER.update(ids=ids, to_lower=to_lower, unknown_id=unknown_id)
+
+
+def _encode_tokens(line):
+    ids, unknown_id = _ENCODER['ids'], _ENCODER['unknown_id']
+    tokens = str_parse(line, _ENCODER['to_lower'])
+    if unknown_id is None:
+        return [ids[token] for token in tokens if token in ids]
+    return [ids.get(token, unknown_id) for token in tokens]
+
+
+def _encode_line(line):
+    return ' '.join(map(str, _encode_tokens(line))) + '\n'
+
+
+def sketch_vocabulary(fnames, top_k = 100000, epsilon = 1e-4, delta = 1e-3, to_lower = True, n_workers = None):
+    """like build_vocabulary, but for corpora whose vocabulary doesn't fit in memory: 
+    every worker fills a CountMinSketch for its byte ranges, and the sketches are merged.
+    Returns the merged sketch; sketch.top() gives the approximate top_k tokens.
+    Every worker's sketch takes about 8*e/epsilon*ln(1/delta) bytes (~1.5 MB for the 
+    defaults, ~150 MB for epsilon = 1e-6), and is pickled back to the parent.
+    """
+    if not isinstance(fnames, list):
+        fnames = [fnames]
+    if n_workers is None:
+        n_workers = multiprocessing.cpu_count()
+    jobs = []
+    for fname in fnames:
+        if _infer_compression(fname, 'r'):
+            jobs.append((fname, None, None, to_lower, top_k, epsilon, delta))
+        else:
+            jobs.extend((fname, start, end, to_lower, top_k, epsilon, delta) \
+                    for start, end in _byte_ranges(fname, n_workers))
+    sketch = CountMinSketch(top_k = top_k, epsilon = epsilon, delta = delta)
+    for partial_sketch in _map_jobs(_sketch_tokens_range, jobs, n_workers):
+        sketch.merge(partial_sketch)
+    return sketch
+
+
+class CountMinSketch(object):
+    """Approximately counts the items of a stream in a fixed amount of memory, and keeps 
+    track of the top_k most frequent items in a heap.  Estimated counts are never too 
+    low, and with probability 1 - delta are too high by at most epsilon times the total 
+    count (see error_bound).  Memory is depth*width counters (depth = ln(1/delta), 
+    width = e/epsilon) plus the top_k items.
+
+    Sketches with the same width and depth can be merged, e.g. after counting different
+    shards in different processes.
+
+    Usage:
+    sketch = CountMinSketch(top_k = 100000, epsilon = 1e-6) # ~150 MB of counters
+    for tokens in str_parse_file("data/mail.tsv"):
+        sketch.update(tokens)
+    print sketch.top(10), sketch['the'], sketch.error_bound()
+    """
+    def __init__(self, width = None, depth = None, top_k = 100, epsilon = 1e-4, delta = 1e-3):
+        """
+        @param int width, depth: the size of the table.  If not given, they are set from 
+              epsilon and delta.
+        @param int top_k: how many of the most frequent items to keep track of.
+        """
+        self.width = int(width or np.ceil(np.e/epsilon))
+        self.depth = int(depth or np.ceil(np.log(1./delta)))
+        self.top_k = top_k
+        self.total = 0
+        self._table = np.zeros((self.depth, self.width), dtype=np.int64)
+        self._top = {} # item -> estimated count, for the current top_k items
+        self._heap = [] # (estimated count, item), possibly with stale entries
+
+    def add(self, item, count = 1):
+        self.update([item], count)
+
+    def update(self, items, count = 1):
+        """counts every item in the iterable items (e.g. the output of str_parse), count 
+        times each.
+        """
+        counts = Counter(items)
+        if not counts:
+            return
+        keys = counts.keys()
+        cols = self._columns(keys)
+        rows = np.arange(self.depth)[:, None]
+        increments = np.array([counts[key] for key in keys], dtype=np.int64)*count
+        np.add.at(self._table, (np.broadcast_to(rows, cols.shape), cols), np.broadcast_to(increments, cols.shape))
+        self.total += int(increments.sum())
+        for key, estimate in zip(keys, self._table[rows, cols].min(axis=0).tolist()):
+            self._offer(key, estimate)
+
+    def __getitem__(self, item):
+        """the estimated count of item."""
+        cols = self._columns([item])
+        return int(self._table[np.arange(self.depth)[:, None], cols].min())
+
+    def merge(self, other):
+        """adds the counts of the sketch other (of the same width and depth) to this one."""
+        if (self.width, self.depth) != (other.width, other.depth):
+            raise ValueError('only sketches of the same width and depth can be merged')
+        self._table += other._table
+        self.total += other.total
+        candidates = set(self._top) | set(other._top)
+        self._top, self._heap = {}, []
+        for item in candidates:
+            self._offer(item, self[item])
+
+    def top(self, n = None):
+        """returns the (at most n) most frequent items as a list of (item, estimated count), 
+        most frequent first.
+        """
+        ranked = sorted(self._top.iteritems(), key=lambda pair: -pair[1])
+        return ranked[:n] if n is not None else ranked
+
+    def error_bound(self):
+        """returns (error, probability): every estimated count is at most error too high, 
+        except with the given probability.
+        """
+        return np.e/self.width*self.total, np.exp(-self.depth)
+
+    #==================================================================
+    # private functions
+
+    def _columns(self, items):
+        """the column of every item in each row of the table, as a (depth, len(items)) 
+        array.  The rows' hashes are derived from two 64 bit halves of an md5 digest, 
+        which unlike hash() are the same in every process.
+        """
+        halves = np.array([struct.unpack('<QQ', hashlib.md5(item.encode('utf-8') \
+                if isinstance(item, unicode) else str(item)).digest()) for item in items], dtype=np.uint64)
+        rows = np.arange(self.depth, dtype=np.uint64)[:, None]
+        return ((halves[:, 0] + rows*halves[:, 1]) % np.uint64(self.width)).astype(np.int64)
+
+    def _offer(self, item, estimate):
+        """updates the top_k items, given the new estimated count of item."""
+        if self.top_k <= 0:
+            return
+        if item in self._top or len(self._top) < self.top_k:
+            self._top[item] = estimate
+            heapq.heappush(self._heap, (estimate, item))
+        else:
+            # estimates only grow, so heap entries that don't match _top are stale
+            while self._top.get(self._heap[0][1]) != self._heap[0][0]:
+                heapq.heappop(self._heap)
+            if estimate <= self._heap[0][0]:
+                return
+            smallest = heapq.heapreplace(self._heap, (estimate, item))[1]
+            del self._top[smallest]
+            self._top[item] = estimate
+        if len(self._heap) > 4*self.top_k + 64:
+            self._heap = [(estimate, item) for item, estimate in self._top.iteritems()]
+            heapq.heapify(self._heap)
+
+
+def _sketch_tokens_range(args):
+    fname, start, end, to_lower, top_k, epsilon, delta = args
+    sketch = CountMinSketch(top_k = top_k, epsilon = epsilon, delta = delta)
+    f = open_file(fname, 'r') if start is None else None
+    lines = f if f is not None else _iter_range_lines(fname, start, end)
+    try:
+        for chunk in iter(lambda: list(itertools.islice(lines, 10000)), []):
+            sketch.update(token for line in chunk for token in str_parse(line, to_lower))
+    finally:
+        if f is not None:
+            f.close()
+    return sketch
 
 
 
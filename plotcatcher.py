@@ -38,17 +38,205 @@
 # ===============================================================================
 
 import matplotlib.pyplot as plt
+import numpy as np
+import atexit
+import multiprocessing
+import numbers
+import Queue
+import re
 import time
+import traceback
+from collections import defaultdict, OrderedDict
+
+
+class _Series(object):
+    """The caught points of one plot id.  The x and y values are kept in numpy buffers 
+    which double in size whenever they fill up, so a point takes 16 bytes instead of a 
+    tuple of two python floats, and the arrays can be handed straight to matplotlib.  
+    Once a value isn't a real number (e.g. a datetime x), its buffer becomes an object 
+    array, which matplotlib takes as well.  Behaves like the list of (x, y) tuples it 
+    replaces.
+    """
+    __slots__ = ('_x', '_y', '_n', 'next_i')
+
+    def __init__(self, capacity = 16):
+        self._x = np.empty(capacity)
+        self._y = np.empty(capacity)
+        self._n = 0
+        # the x of the next point, for the default parser; see PlotCatcher._prev_i
+        self.next_i = 0
+
+    def append(self, point):
+        x, y = point
+        if self._n == len(self._x):
+            self._x = np.resize(self._x, 2*len(self._x))
+            self._y = np.resize(self._y, 2*len(self._y))
+        if not isinstance(x, numbers.Real) and self._x.dtype != object:
+            self._x = self._x.astype(object)
+        if not isinstance(y, numbers.Real) and self._y.dtype != object:
+            self._y = self._y.astype(object)
+        self._x[self._n] = x
+        self._y[self._n] = y
+        self._n += 1
+        try:
+            self.next_i = x + 1
+        except TypeError:
+            pass
+
+    @property
+    def x(self):
+        return self._x[:self._n]
+
+    @property
+    def y(self):
+        return self._y[:self._n]
+
+    def __len__(self):
+        return self._n
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return zip(self.x[i], self.y[i])
+        return self.x[i], self.y[i]
+
+    def __iter__(self):
+        return iter(zip(self.x, self.y))
+
+
+def _minmax_downsample(x, y, n_buckets):
+    """cuts the x range into n_buckets equal buckets (e.g. one per pixel) and keeps only 
+    the lowest and highest point in each, in their original order, so that the plotted 
+    envelope of the line looks the same.  Returns the kept x and y.
+    """
+    if len(x) <= 2*n_buckets:
+        return x, y
+    span = x.max() - x.min()
+    bucket = ((x - x.min())*(n_buckets/span if span else 0)).astype(int)
+    np.minimum(bucket, n_buckets - 1, out=bucket)
+    # sorted by bucket and then y, so each bucket's min is first and its max last
+    order = np.lexsort((y, bucket))
+    first = np.r_[True, bucket[order][1:] != bucket[order][:-1]]
+    last = np.r_[first[1:], True]
+    keep = np.unique(np.r_[order[first], order[last]])
+    return x[keep], y[keep]
+
+
+def _lttb_downsample(x, y, n_out):
+    """Largest-Triangle-Three-Buckets: keeps the first and last points, and from each of 
+    n_out - 2 equal buckets of points in between, the one making the largest triangle with 
+    the point kept from the previous bucket and the average of the next bucket.  This 
+    keeps the shape of the line well with few points.  Returns the kept x and y.
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return x, y
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    keep = np.empty(n_out, dtype=int)
+    keep[0], keep[-1] = 0, n - 1
+    a = 0
+    for i in xrange(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        avg_x, avg_y = x[end:next_end].mean(), y[end:next_end].mean()
+        area = np.abs((x[a] - avg_x)*(y[start:end] - y[a]) - (x[a] - x[start:end])*(avg_y - y[a]))
+        a = start + int(area.argmax())
+        keep[i + 1] = a
+    return x[keep], y[keep]
+
+
+def _apply_attributes(attrib):
+    """
+    sets the attributes (title, xlim, etc) of the current plot.  Returns 
+    the location of the legend for that plot
+    """
+    if 'title' in attrib:
+        plt.title(attrib['title'])
+    if 'xlim' in attrib:
+        plt.xlim(*attrib['xlim'])
+    if 'ylim' in attrib:
+        plt.ylim(*attrib['ylim']) 
+    if 'x_label' in attrib:
+        plt.x_label(*attrib['x_label'])
+    if 'y_label' in attrib:
+        plt.y_label(*attrib['y_label'])
+
+    #note: options for legend loc include "lower left", "left", "center", etc, 
+    return attrib.get('legend_loc', 'best')
+
+
+def _draw(pids, series, colors, attrib):
+    """draws the (x, y) arrays in series, one per pid, on the current plot, 
+    with the given colors (None for the default) and attributes.
+    """
+    plt_objs = []
+    for (domain, values), c in zip(series, colors):
+        if c:
+            pi, = plt.plot(domain, values, c)
+        else:
+            pi, = plt.plot(domain, values)
+        plt_objs.append(pi)
+
+    plt.title(", ".join(pids)) #This will be overwritten if another title is supplied
+    legend_loc = _apply_attributes(attrib)
+    plt.legend(plt_objs, pids, loc=legend_loc)
+
+
+def _render_worker(jobs, done):
+    """the background rendering process of a PlotCatcher.  Takes (seq, pids, job) 
+    from jobs, renders every job to its file with the Agg backend, and puts 
+    ('done', seq) on done when it has dealt with every job up to seq.  If several 
+    jobs for the same pids and file are waiting, only the latest one is rendered.
+    """
+    plt.switch_backend('Agg')
+    while True:
+        msgs = [jobs.get()]
+        while msgs[-1] is not None:
+            try:
+                msgs.append(jobs.get_nowait())
+            except Queue.Empty:
+                break
+        latest = OrderedDict()
+        for msg in msgs:
+            if msg is not None:
+                seq, pids, job = msg
+                # job[-1] is the file the plot is saved to
+                latest.pop((pids, job[-1]), None)
+                latest[pids, job[-1]] = job
+        for (pids, _), (series, colors, attrib, save_fname) in latest.items():
+            try:
+                fig = plt.figure()
+                _draw(list(pids), series, colors, attrib)
+                fig.savefig(save_fname)
+                plt.close(fig)
+            except Exception:
+                done.put(('error', traceback.format_exc()))
+        if latest:
+            done.put(('done', seq))
+        if msgs[-1] is None:
+            return
+
 
 class PlotCatcher:
     """ A module to allow you to automatically plot things from your code with minimal effort.
     """
-    def __init__(self, save_dir='./'):
+    def __init__(self, save_dir='./', background=False):
+        """
+        @param str save_dir: where plots are saved
+        @param bool background: if set, plots which are saved but not shown 
+              (plotByIds(..., save=True, plot=False)) are rendered and saved by a 
+              background process, so the calling script doesn't wait for them.  
+              Call flush() to wait for them to be written.
+        """
         if save_dir[-1] != '/':
             save_dir += '/'
         self._save_dir = save_dir
 
-        self.plots = defaultdict(list)
+        self._background = background
+        self._worker = None
+        self._n_sent = self._n_done = 0
+
+        # self.plots maps each pid to a _Series of its points
+        self.plots = defaultdict(_Series)
 
         # self._gb__plot_attributes are global attributes that are called for any plot
         self._gb_plot_attributes = {}
@@ -77,7 +265,9 @@ class PlotCatcher:
         @param str pid: the id of the plot who you are adding things to
         @param tuple_parser: a fuction of the tuple which outputs a tuple of 
                 (domain, function_value),
-                or () if the input tuple should be ignored.
+                or () if the input tuple should be ignored.  The values are kept 
+                as floats while they are real numbers, and as python objects 
+                (e.g. datetimes) otherwise.
         @param str c: the color/style of the plot of this caught value, e.g. 'b', 'ro', 'k--', etc.  There can only be one color per plot id.
         """
         if tuple_parser is None:
@@ -114,6 +304,11 @@ class PlotCatcher:
         @param dict attributes: a dict mapping attributes to their values, e.g.
                 {'title': 'my best graph', 'xlim': (0, 1)}
 
+        Besides the matplotlib ones, the attribute 'downsample' thins out long 
+        series when they are drawn (the caught data is left as it is):
+        'minmax' keeps the lowest and highest point of every x bucket, and 'lttb'
+        uses Largest-Triangle-Three-Buckets.  'downsample_points' is about how
+        many points are drawn (default 2000).
         """
 
         if isinstance(pids, str): pids = [pids]
@@ -142,20 +337,16 @@ class PlotCatcher:
     def plotByIds(self, pids, save=False, plot=True, file_label=''):
         """plots on a single plots associated with the list 
         of pids.  if pids is a string, just that one graph is plotted.
+
+        If this PlotCatcher renders in the background and the plot is only 
+        saved, a copy of the data is sent to the background process and 
+        this returns right away.  If the same pids are saved to the same 
+        file again before the process gets to them, only the latest copy 
+        is rendered.
         """
         if isinstance(pids, str): pids = [pids]
-        plt_objs = []
-        for pid in pids:
-            domain, values = zip(*self.plots[pid])
-            if pid in self.pid_colors:
-                pi, = plt.plot(domain, values, self.pid_colors[pid])
-            else:
-                pi, = plt.plot(domain, values)                
-            plt_objs.append(pi)
-
-        plt.title(", ".join(pids)) #This will be overwritten if another title is supplied
-        legend_loc = self._set_attributes(pids[0])
-        plt.legend(plt_objs, pids, loc=legend_loc)
+        series = [self._downsample(self.plots[pid].x, self.plots[pid].y, pid) for pid in pids]
+        colors = [self.pid_colors.get(pid) for pid in pids]
 
         if save:
             if file_label: file_label = '_' + file_label
@@ -164,10 +355,50 @@ class PlotCatcher:
                     + self._timestring() \
                     + file_label + '.png'
             print save_fname
+            if self._background and not plot:
+                # the buffers keep growing, so send copies
+                series = [(np.array(x), np.array(y)) for x, y in series]
+                self._send((series, colors, self._attributes(pids[0]), save_fname), pids)
+                return
+
+        _draw(pids, series, colors, self._attributes(pids[0]))
+        if save:
             plt.savefig(save_fname)
         if plot:
             plt.show()
 
+    def flush(self):
+        """waits until every plot sent to the background process has been 
+        saved.  Raises a RuntimeError if any of them failed.
+        """
+        errors = []
+        while self._n_done < self._n_sent:
+            try:
+                msg = self._done.get(timeout=1)
+            except Queue.Empty:
+                if not self._worker.is_alive():
+                    raise RuntimeError('the background rendering process died')
+                continue
+            if msg[0] == 'error':
+                errors.append(msg[1])
+            else:
+                self._n_done = msg[1]
+        if errors:
+            raise RuntimeError('rendering a plot in the background failed:\n' + errors[0])
+
+    def close(self):
+        """waits for the background process to save every plot sent to it, 
+        and stops it.
+        """
+        if self._worker is None:
+            return
+        try:
+            self.flush()
+        finally:
+            self._jobs.put(None)
+            self._worker.join()
+            self._worker = None
+
     def sklearn_clf_rpt_parser(self, rpt, pid):
         """
         A parser which picks up the f1 score from the sklearn
@@ -187,25 +418,48 @@ class PlotCatcher:
         location of the legend for that plot
         """
 
+        return _apply_attributes(self._attributes(pid))
+
+    def _send(self, job, pids):
+        """hands job to the background rendering process, starting it if 
+        need be.
+        """
+        if self._worker is None:
+            self._jobs = multiprocessing.Queue()
+            self._done = multiprocessing.Queue()
+            self._worker = multiprocessing.Process(target=_render_worker, args=(self._jobs, self._done))
+            self._worker.daemon = True
+            self._worker.start()
+            self._n_sent = self._n_done = 0
+            atexit.register(self.close)
+        self._n_sent += 1
+        self._jobs.put((self._n_sent, tuple(pids), job))
+
+    def _attributes(self, pid):
+        """the attributes of the plot for the given pid: the global ones, 
+        overridden by its own.
+        """
         attrib = dict(self._gb_plot_attributes)
         attrib.update(dict(self._plot_attributes.get(pid, {})))
+        return attrib
 
-        if 'title' in attrib:
-            plt.title(attrib['title'])
-        if 'xlim' in attrib:
-            plt.xlim(*attrib['xlim'])
-        if 'ylim' in attrib:
-            plt.ylim(*attrib['ylim']) 
-        if 'x_label' in attrib:
-            plt.x_label(*attrib['x_label'])
-        if 'y_label' in attrib:
-            plt.y_label(*attrib['y_label'])
-
-        #note: options for legend loc include "lower left", "left", "center", etc, 
-        return attrib.get('legend_loc', 'best')
+    def _downsample(self, x, y, pid):
+        """thins out the points of pid for drawing, as set by its 'downsample'
+        attribute.  Series with values that aren't real numbers are drawn as they are.
+        """
+        attrib = self._attributes(pid)
+        method = attrib.get('downsample')
+        n_points = attrib.get('downsample_points', 2000)
+        if method is None or object in (x.dtype, y.dtype):
+            return x, y
+        if method == 'minmax':
+            return _minmax_downsample(x, y, max(1, n_points//2))
+        if method == 'lttb':
+            return _lttb_downsample(x, y, n_points)
+        raise ValueError("unknown downsample method %s (use 'minmax' or 'lttb')"%method)
 
     def _prev_i(self, pid):
-        return self.plots[pid][-1][0] + 1 if self.plots[pid] else 0
+        return self.plots[pid].next_i
 
 
     def _timestring(self, precision='day'):
@@ -229,10 +483,6 @@ class PlotCatcher:
 
 
 if __name__=="__main__":
-    from collections import defaultdict; import numpy as np; import re
-
-
-        
     pc = PlotCatcher()
 
     #=================================================================
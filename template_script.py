@@ -80,15 +80,14 @@ def get_args():
 
 if __name__ == '__main__':
     print 'You are running this from the command line, so you must be testing it!'
-    start_time = time.time()
+    with gutil.timer('computation'):
+        domain = range(k)
+        f_1 = [i**2 for i in domain]
+        f_2 = [np.sin(i) for i in domain]
+        f_3 = [np.random.rand()*i for i in domain]
 
-    domain = range(k)
-    f_1 = [i**2 for i in domain]
-    f_2 = [np.sin(i) for i in domain]
-    f_3 = [np.random.rand()*i for i in domain]
 
-
-    colorprint("time to do computation: %s"%(time.time() - start_time))
+    gutil.TIMINGS.report()
     colorprint(time_string())
 
 
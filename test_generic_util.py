@@ -0,0 +1,164 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+#
+# File: test_generic_util.py
+#
+#===============================================================================
+# DESCRIPTION:
+#
+# Regression tests for generic_util.
+#
+#===============================================================================
+# USAGE:
+# python -m unittest test_generic_util
+#
+#===============================================================================
+
+
+#standard modules
+import json
+import os
+import random
+import StringIO
+import shutil
+import tempfile
+import unittest
+
+#third party modules
+import numpy as np
+import generic_util as gu
+
+
+class ParseNumberLinesTest(unittest.TestCase):
+
+    def test_trailing_bad_token_raises(self):
+        # np.fromstring stops at the first bad token, which went unnoticed at the end of a block
+        for text in ['1 2\n3 4.5\n', '7 1e3\n', '4 0x10\n', '3 -\n', '1-2 3x 5\n']:
+            self.assertRaises(ValueError, gu._parse_number_lines, text, int)
+        self.assertRaises(ValueError, gu._parse_number_lines, '1.5 2x\n', float)
+
+    def test_overflow_keeps_exact_value(self):
+        values, counts = gu._parse_number_lines('99999999999999999999 1\n', int)
+        self.assertEqual(values.tolist(), [99999999999999999999, 1])
+        self.assertEqual(counts.tolist(), [2])
+
+    def test_counts(self):
+        values, counts = gu._parse_number_lines('-5 +6\n\n3\n', int)
+        self.assertEqual(values.tolist(), [-5, 6, 3])
+        self.assertEqual(counts.tolist(), [2, 0, 1])
+
+
+class ProgressTest(unittest.TestCase):
+
+    def test_file_progress_reports_done(self):
+        out_dir = tempfile.mkdtemp()
+        try:
+            fname = os.path.join(out_dir, 'lines.txt')
+            with open(fname, 'w') as f:
+                f.write(''.join('%s\n'%i for i in range(100)))
+            report = StringIO.StringIO()
+            gu.randomly_sample_file(fname, os.path.join(out_dir, 'sample.txt'), 10, progress = report)
+            statuses = [json.loads(line) for line in report.getvalue().splitlines()]
+            self.assertTrue(statuses[-1]['done'])
+        finally:
+            shutil.rmtree(out_dir, ignore_errors=True)
+
+
+class InferCompressionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_text_starting_with_bz2_prefix(self):
+        fname = os.path.join(self.dir, 'names.txt')
+        with open(fname, 'w') as f:
+            f.write('BZhang is a name\n')
+        self.assertEqual(gu._infer_compression(fname, 'r'), None)
+        self.assertEqual(list(gu.str_parse_file(fname)), [['bzhang', 'is', 'a', 'name']])
+
+    def test_bz2(self):
+        for i, content in enumerate(['', 'some text\n']):
+            fname = os.path.join(self.dir, 'file_%s.txt.bz2'%i)
+            with gu.open_file(fname, 'w') as f:
+                f.write(content)
+            self.assertEqual(gu._infer_compression(fname, 'r'), 'bz2')
+            with gu.open_file(fname) as f:
+                self.assertEqual(f.read(), content)
+
+
+class KeyHashTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.fname = os.path.join(self.dir, 'lines.txt')
+        with open(self.fname, 'w') as f:
+            f.write(''.join('%s row%s\n'%(i%7, i) for i in range(100)))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_non_string_key(self):
+        int_key = lambda line: int(line.split()[0])
+        split_dir = os.path.join(self.dir, 'split')
+        gu.split_file(self.fname, split_dir, n_splits = 3, mode = 'key', key = int_key, seed = 1)
+        owners = {}
+        for i in range(3):
+            with open(os.path.join(split_dir, 'split_%s'%i)) as f:
+                for line in f:
+                    self.assertEqual(owners.setdefault(line.split()[0], i), i)
+        self.assertEqual(len(owners), 7)
+        names = [os.path.join(self.dir, name) for name in ['train', 'dev']]
+        gu.make_dev_train_sets(self.fname, names, [.5, .5], assign = 'hash', key = int_key)
+        self.assertEqual(sum(len(open(name).readlines()) for name in names), 100)
+
+
+class TimingRegistryTest(unittest.TestCase):
+
+    def test_doesnt_use_global_random(self):
+        registry = gu.TimingRegistry()
+        random.seed(0)
+        expected = [random.random() for _ in range(5)]
+        random.seed(0)
+        actual = []
+        for _ in range(5):
+            for _ in range(registry.MAX_SAMPLES + 10):
+                registry.record('x', 1)
+            actual.append(random.random())
+        self.assertEqual(actual, expected)
+
+
+class CountMinSketchTest(unittest.TestCase):
+
+    def test_no_top_k(self):
+        sketch = gu.CountMinSketch(top_k = 0)
+        sketch.update(['a', 'b', 'a'])
+        self.assertEqual(sketch.top(), [])
+        self.assertEqual(sketch['a'], 2)
+
+
+class FileGeneratorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def test_trailing_bad_token_raises(self):
+        fname = os.path.join(self.dir, 'numbers.txt')
+        with open(fname, 'w') as f:
+            f.write('1 2\n3 4.5\n')
+        self.assertRaises(ValueError, list, gu.file_generator(fname))
+
+    def test_rows(self):
+        fname = os.path.join(self.dir, 'numbers.txt')
+        with open(fname, 'w') as f:
+            f.write('1 2\n\n3 -4')
+        self.assertEqual(list(gu.file_generator(fname)), [[1, 2], [], [3, -4]])
+
+
+if __name__ == '__main__':
+    unittest.main()